@@ -1,6 +1,8 @@
+import asyncio
+import logging
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from os.path import join, dirname
@@ -8,10 +10,13 @@ from sqlalchemy.orm import Session
 from typing import Annotated
 import os
 
-from api.dps import get_db
-from common.crud import get_user_by_username
-from common.schemas import TokenData, Token, User
-from common.security import verify_password
+from api.dps import background_session, get_db, run_db
+from common.crud import (
+    create_refresh_token, get_user_by_username, purge_refresh_tokens, revoke_refresh_token, rotate_refresh_token,
+    update_user_password_hash)
+from common.principals import Principal, principal_cache
+from common.schemas import TokenData, Token, TokenRefresh, User
+from common.security import PasswordHasherBusy, verify_password_async
 
 
 load_dotenv(verbose=True)
@@ -23,20 +28,63 @@ PASSWORD_SECRET_KEY = os.environ.get("PASSWORD_SECRET_KEY")
 HASH_ALGORITHM = os.environ.get("HASH_ALGORITHM")
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+# Seconds between deletions of expired and revoked refresh tokens.
+REFRESH_TOKEN_PURGE_INTERVAL = float(os.environ.get("REFRESH_TOKEN_PURGE_INTERVAL", 3600))
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 router = APIRouter()
 
+logger = logging.getLogger("uvicorn.error")
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user_by_username(db, username)
+
+async def purge_refresh_tokens_periodically():
+    while True:
+        await asyncio.sleep(REFRESH_TOKEN_PURGE_INTERVAL)
+        try:
+            async with background_session() as db:
+                await run_db(db, purge_refresh_tokens)
+        except Exception:
+            logger.exception("Purging refresh tokens failed; retrying next interval")
+
+
+async def authenticate_user(db, username: str, password: str):
+    user = await run_db(db, get_user_by_username, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    # Read before a rehash commits and expires the ORM user, so callers
+    # never reload it on the event loop.
+    principal = Principal(id=user.id, username=user.username)
+    try:
+        valid, new_hash = await verify_password_async(password, user.hashed_password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress, please retry",
+            headers={"Retry-After": "1"},
+        )
+    if not valid:
         return False
-    return user
+    if new_hash:
+        await run_db(db, update_user_password_hash, principal.id, new_hash)
+    return principal
+
+
+def rate_limit_key(request: Request) -> str:
+    # Signed-in clients are limited per user, whatever address they come
+    # from; anyone else (or a token that does not verify) per IP.
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            username = jwt.decode(token, PASSWORD_SECRET_KEY, algorithms=[HASH_ALGORITHM]).get("sub")
+        except JWTError:
+            username = None
+        if username:
+            return f"user:{username}"
+    return f"ip:{request.client.host if request.client else ''}"
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -55,7 +103,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
 ):
-    user = authenticate_user(
+    user = await authenticate_user(
         db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -67,7 +115,31 @@ async def login_for_access_token(
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token = await run_db(
+        db, create_refresh_token, user.id, expires_in=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+
+@router.post("/token/refresh", response_model=Token, description="Exchanges a refresh token for a new access token and a new refresh token. Each refresh token works once; reusing one revokes every token issued from the same login.")
+async def refresh_access_token(body: TokenRefresh, db: Session = Depends(get_db)):
+    rotated = await run_db(
+        db, rotate_refresh_token, body.refresh_token, expires_in=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+    if rotated is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    username, refresh_token = rotated
+    access_token = create_access_token(
+        data={"sub": username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+
+@router.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT, description="Logs out: revokes a refresh token and every token issued from the same login.")
+async def revoke_token(body: TokenRefresh, db: Session = Depends(get_db)):
+    await run_db(db, revoke_refresh_token, body.refresh_token)
 
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
@@ -76,6 +148,11 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # A cached entry implies the token was already verified and has not
+    # expired yet, so the decode and the DB lookup can both be skipped.
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     try:
         payload = jwt.decode(token, PASSWORD_SECRET_KEY,
                              algorithms=[HASH_ALGORITHM])
@@ -85,10 +162,13 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user_by_username(db, username=token_data.username)
+    user = await run_db(db, get_user_by_username, username=token_data.username)
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal(id=user.id, username=user.username)
+    # Tokens without an exp claim fall back to the cache's own TTL.
+    principal_cache.put(token, principal, payload.get("exp"))
+    return principal
 
 
 async def get_current_active_user(
@@ -1,18 +1,49 @@
-from fastapi import APIRouter, Depends
+import asyncio
+import logging
+import math
+from datetime import datetime
+from typing import Literal
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, Request, Response
 from fastapi.exceptions import HTTPException
 from fastapi.security import OAuth2PasswordBearer
 
 from sqlalchemy.orm import Session
 
 
-from api.dps import get_db
+from api.dps import background_session, bulk_result, cache_entry, from_replica, get_cursor, get_db, get_read_db, render_cached, respond, run_db, validate_bulk
 from api import auth
-from common import schemas, crud
+from common import schemas, crud, rendering
+from common.cache import CacheEntry, response_cache
+from common.pagination import NEXT_CURSOR_HEADER, next_cursor
+from common.trending import ACTIVITY_FLUSH_INTERVAL, TRENDING_MAX_LIMIT, activity
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+logger = logging.getLogger("uvicorn.error")
+
+
+async def flush_activity():
+    views, comments = activity.drain()
+    if not views and not comments:
+        return
+    try:
+        async with background_session() as db:
+            await run_db(db, crud.flush_activity, views=views, comments=comments)
+    except Exception:
+        activity.restore(views, comments)
+        raise
+
+
+async def flush_activity_periodically():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await flush_activity()
+        except Exception:
+            logger.exception("Flushing blog activity failed; retrying next interval")
+
 
 @router.post("/blog/", response_model=schemas.Blog, tags=["blog"], description="Create a new blog")
 async def create_blog(
@@ -20,47 +51,145 @@ async def create_blog(
     token: str = Depends(oauth2_scheme)
 ):
     user = await auth.get_current_user(token, db)
-    print("user_id: " + str(user.id))
-    return crud.create_blog(db=db, blog=blog, owner_id=user.id)
+    return respond(await run_db(db, crud.create_blog, blog=blog, owner_id=user.id, schema=schemas.Blog))
 
 
-@router.get("/blog/", response_model=list[schemas.BlogSummary], tags=["blog"], description="Returns a list of blog summaries.")
-def read_blogs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    blogs = crud.get_blogs(db, skip=skip, limit=limit)
-    return blogs
+@router.post("/blog/bulk", response_model=schemas.BulkResult, tags=["blog"], description="Creates many blogs in one transaction. Invalid items are reported by index and skipped.")
+async def create_blogs_bulk(
+    items: list = Body(...), db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)
+):
+    user = await auth.get_current_user(token, db)
+    indexes, blogs, errors = validate_bulk(schemas.BlogCreate, items)
+    ids = await run_db(db, crud.create_blogs_bulk, owner_id=user.id, blogs=blogs)
+    return bulk_result(indexes, ids, errors)
 
 
-@router.get("/blog/{id}", response_model=schemas.Blog, tags=["blog"], description="Returns a blog.")
-def read_blog(id: int, db: Session = Depends(get_db)):
-    db_blog = crud.get_blog_by_id(db, blog_id=id)
-    if db_blog is None:
+@router.get("/blog/", response_model=list[schemas.BlogSummary], tags=["blog"], description="Returns a list of blog summaries, newest first. Pass the `X-Next-Cursor` response header back as `cursor` to fetch the next page.")
+async def read_blogs(
+    request: Request, skip: int = 0, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(datetime, int)), db: Session = Depends(get_read_db)
+):
+    key = response_cache.blog_list_key(skip, limit, after)
+    entry = response_cache.get(key)
+    if entry is None:
+        blogs = await run_db(db, crud.get_blogs, skip=skip, limit=limit, after=after, schema=list[schemas.BlogSummary])
+        cursor = next_cursor(blogs, limit, lambda b: (b.updated_at, b.id))
+        entry = cache_entry(blogs, headers={NEXT_CURSOR_HEADER: cursor} if cursor else None)
+        response_cache.set(key, entry, from_replica=from_replica(db))
+    return render_cached(request, entry)
+
+
+@router.get("/blog/search", response_model=list[schemas.BlogSearchResult], tags=["blog"], description="Searches blog titles, descriptions and contents, best match first. Pass the `X-Next-Cursor` response header back as `cursor` to fetch the next page.")
+async def search_blogs(
+    q: str, response: Response, limit: int = 20,
+    after: tuple | None = Depends(get_cursor(float, int)), db: Session = Depends(get_read_db)
+):
+    blogs = await run_db(db, crud.search_blogs, q=q, limit=limit, after=after, schema=list[schemas.BlogSearchResult])
+    cursor = next_cursor(blogs, limit, lambda b: (b.rank, b.id))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(blogs, response)
+
+
+@router.get("/blog/trending", response_model=list[schemas.TrendingBlogSummary], tags=["blog"], description="Returns the blogs with the most recent views and comments, hottest first.")
+async def read_trending_blogs(request: Request, limit: int = 20, db: Session = Depends(get_read_db)):
+    limit = max(1, min(limit, TRENDING_MAX_LIMIT))
+    key = response_cache.trending_key(limit)
+    entry = response_cache.get(key)
+    if entry is None:
+        blogs = await run_db(db, crud.get_trending_blogs, limit=limit, schema=list[schemas.TrendingBlogSummary])
+        entry = cache_entry(blogs)
+        # Other workers' flushes only reach a per-process cache by expiry.
+        response_cache.set(key, entry, ttl=math.ceil(ACTIVITY_FLUSH_INTERVAL), from_replica=from_replica(db))
+    return render_cached(request, entry)
+
+
+# Blogs whose renditions are being stored after a request found none.
+_rendering: set[int] = set()
+
+
+async def _store_missing_renditions(blog_id: int):
+    try:
+        async with background_session() as db:
+            await run_db(db, crud.store_missing_renditions, blog_id=blog_id)
+    except Exception:
+        # A concurrent update stored them first; `python -m common.rendering`
+        # catches anything still missing.
+        logger.exception("Storing renditions for blog %d failed", blog_id)
+    finally:
+        _rendering.discard(blog_id)
+
+
+@router.get("/blog/{id}", response_model=schemas.Blog, tags=["blog"], description="Returns a blog. With `format=html` or `format=markdown`, returns just its content as a document, precompressed per `Accept-Encoding`.")
+async def read_blog(
+    id: int, request: Request, background_tasks: BackgroundTasks,
+    format: Literal["json", "html", "markdown"] = "json", db: Session = Depends(get_read_db)
+):
+    if format != "json":
+        rendition = await run_db(
+            db, crud.get_blog_rendition, blog_id=id, format=format,
+            encoding=rendering.negotiate(request.headers.get("accept-encoding")))
+        if rendition is None:
+            raise HTTPException(status_code=404, detail="Blog not found")
+        if not rendition.stored and id not in _rendering:
+            _rendering.add(id)
+            background_tasks.add_task(_store_missing_renditions, id)
+        encoding = rendition.encoding
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        # Renditions only change with updated_at, so that is their version.
+        etag = f'"{id}-{rendition.updated_at.timestamp()}-{format}-{encoding}"'
+        entry = CacheEntry(rendition.body, etag, rendition.updated_at, headers)
+        activity.view(id)
+        return render_cached(request, entry, media_type=rendering.FORMATS[format])
+
+    key = response_cache.blog_key(id)
+    entry = response_cache.get(key)
+    if entry is None:
+        db_blog = await run_db(db, crud.get_blog_detail, blog_id=id, schema=schemas.Blog)
+        if db_blog is None:
+            raise HTTPException(status_code=404, detail="Blog not found")
+        # Comments are part of the body, so they count towards its age too.
+        last_modified = max([db_blog.updated_at, *(c.updated_at for c in db_blog.comments)])
+        entry = cache_entry(db_blog, last_modified=last_modified)
+        response_cache.set(key, entry, from_replica=from_replica(db))
+    activity.view(id)
+    return render_cached(request, entry)
+
+
+async def _not_found_or_not_owner(id: int, db: Session):
+    # Only reached when a write matched no row: tells the two cases apart.
+    if await run_db(db, crud.get_blog_owner_id, blog_id=id) is None:
         raise HTTPException(status_code=404, detail="Blog not found")
-    return db_blog
+    raise HTTPException(
+        status_code=405, detail="Not allowed! you are not the owner of this blog")
 
 
 @router.put("/blog/{id}", response_model=schemas.Blog, tags=["blog"], description="Updates a blog.")
 async def update_blog(id: int, blog: schemas.BlogCreate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = await auth.get_current_user(token, db)
-    db_blog = crud.get_blog_by_id(db, blog_id=id)
+    db_blog = await run_db(db, crud.update_blog, blog_id=id, owner_id=user.id, changes=blog.dict(), schema=schemas.Blog)
     if db_blog is None:
-        raise HTTPException(status_code=404, detail="Blog not found")
-    if db_blog.owner_id != user.id:
-        raise HTTPException(
-            status_code=405, detail="Not allowed! you are not the owner of this blog")
+        await _not_found_or_not_owner(id, db)
+    return respond(db_blog)
 
-    db_blog = crud.update_blog(db, blog_id=id, blog=blog)
-    return db_blog
+
+@router.patch("/blog/{id}", response_model=schemas.Blog, tags=["blog"], description="Updates only the given fields of a blog.")
+async def patch_blog(id: int, blog: schemas.BlogUpdate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    user = await auth.get_current_user(token, db)
+    changes = blog.dict(exclude_unset=True, exclude_none=True)
+    db_blog = await run_db(db, crud.update_blog, blog_id=id, owner_id=user.id, changes=changes, schema=schemas.Blog)
+    if db_blog is None:
+        await _not_found_or_not_owner(id, db)
+    return respond(db_blog)
 
 
 @router.delete("/blog/{id}", response_model=schemas.Blog, tags=["blog"], description="Deletes a blog.")
 async def delete_blog(id: int, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = await auth.get_current_user(token, db)
-    db_blog = crud.get_blog_by_id(db, blog_id=id)
+    db_blog = await run_db(db, crud.delete_blog, blog_id=id, owner_id=user.id, schema=schemas.Blog)
     if db_blog is None:
-        raise HTTPException(status_code=404, detail="Blog not found")
-    if db_blog.owner_id != user.id:
-        raise HTTPException(
-            status_code=405, detail="Not allowed! you are not the owner of this blog")
-
-    db_blog = crud.delete_blog(db, blog_id=id)
-    return db_blog
+        await _not_found_or_not_owner(id, db)
+    return respond(db_blog)
@@ -1,13 +1,15 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from fastapi.exceptions import HTTPException
 from fastapi.security import OAuth2PasswordBearer
 
 from sqlalchemy.orm import Session
 
 
-from api.dps import get_db
+from api.dps import BULK_MAX_ITEMS, cache_entry, from_replica, get_cursor, get_db, get_read_db, render_cached, respond, run_db
 from api import auth
 from common import schemas, crud
+from common.cache import response_cache
+from common.pagination import NEXT_CURSOR_HEADER, next_cursor
 
 router = APIRouter()
 
@@ -15,27 +17,57 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 @router.get("/category/", response_model=list[schemas.Category], tags=["category"], description="Returns a list of categories.")
-def read_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    categories = crud.get_categories(db, skip=skip, limit=limit)
-    return categories
+async def read_categories(
+    request: Request, skip: int = 0, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(int)), db: Session = Depends(get_read_db)
+):
+    key = response_cache.category_list_key(skip, limit, after)
+    entry = response_cache.get(key)
+    if entry is None:
+        categories = await run_db(db, crud.get_categories, skip=skip, limit=limit, after=after, schema=list[schemas.Category])
+        cursor = next_cursor(categories, limit, lambda c: (c.id,))
+        entry = cache_entry(categories, headers={NEXT_CURSOR_HEADER: cursor} if cursor else None)
+        response_cache.set(key, entry, from_replica=from_replica(db))
+    return render_cached(request, entry)
+
+
+@router.get("/category/facets", response_model=list[schemas.CategoryFacet], tags=["category"], description="Returns categories with their post counts, most used first.")
+async def read_category_facets(limit: int = 100, db: Session = Depends(get_read_db)):
+    return respond(await run_db(db, crud.get_category_facets, limit=limit, schema=list[schemas.CategoryFacet]))
 
 
 @router.get("/category/{id}", response_model=schemas.Category, tags=["category"], description="Returns a category.")
-def read_category(id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_id(db, category_id=id)
+async def read_category(id: int, db: Session = Depends(get_read_db)):
+    db_category = await run_db(db, crud.get_category_by_id, category_id=id, schema=schemas.Category)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
-    return db_category
+    return respond(db_category)
+
+
+@router.get("/category/{id}/blog/", response_model=list[schemas.BlogSummary], tags=["category"], description="Returns blogs in a category, newest first. Pass the `X-Next-Cursor` response header back as `cursor` to fetch the next page.")
+async def read_category_blogs(
+    id: int, response: Response, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(int)), db: Session = Depends(get_read_db)
+):
+    blogs = await run_db(db, crud.get_blogs_by_category_id, category_id=id, limit=limit, after=after, schema=list[schemas.BlogSummary])
+    cursor = next_cursor(blogs, limit, lambda b: (b.id,))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(blogs, response)
 
 
 @router.get("/blog/{blog_id}/category/", response_model=list[schemas.Category], tags=["category"], description="Returns a list of blog categories.")
-def read_category(blog_id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_categories_by_blog_id(db, blog_id=blog_id)
-    if db_category is None:
-        raise HTTPException(
-            status_code=204, detail="Category not defined for this blog")
-    print(db_category)
-    return db_category
+async def read_category(blog_id: int, request: Request, db: Session = Depends(get_read_db)):
+    key = response_cache.blog_categories_key(blog_id)
+    entry = response_cache.get(key)
+    if entry is None:
+        db_category = await run_db(db, crud.get_categories_by_blog_id, blog_id=blog_id, schema=list[schemas.Category])
+        if db_category is None:
+            raise HTTPException(
+                status_code=204, detail="Category not defined for this blog")
+        entry = cache_entry(db_category)
+        response_cache.set(key, entry, from_replica=from_replica(db))
+    return render_cached(request, entry)
 
 
 @router.post("/blog/{blog_id}/category", response_model=schemas.BlogCategory, tags=["category"])
@@ -44,20 +76,36 @@ async def create_category_for_blog(
     token: str = Depends(oauth2_scheme)
 ):
     user = await auth.get_current_user(token, db)
-    db_blog = crud.get_blog_by_id(db, blog_id=blog_id)
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
     if db_blog is None:
         raise HTTPException(status_code=404, detail="Blog not found")
     if db_blog.owner_id != user.id:
         raise HTTPException(
             status_code=405, detail="Not allowed! you are not the owner of this blog")
-    db_category = crud.get_category_by_name(db, name=category.name)
-    if db_category is None:
-        db_category = crud.create_category(
-            db=db, category=category)
-    if crud.check_blog_category(db, blog_id, category_id=db_category.id):
+    db_category = await run_db(db, crud.get_or_create_category, name=category.name)
+    if await run_db(db, crud.check_blog_category, blog_id, category_id=db_category.id):
         raise HTTPException(
             status_code=405, detail="This category already defined for this blog")
-    return crud.add_blog_category(db=db, blog_id=blog_id, category_id=db_category.id)
+    return respond(await run_db(db, crud.add_blog_category, blog_id=blog_id, category_id=db_category.id, schema=schemas.BlogCategory))
+
+
+@router.put("/blog/{blog_id}/category", response_model=list[schemas.Category], tags=["category"], description="Replaces a blog's categories with the given ones, creating any that do not exist yet.")
+async def set_categories_for_blog(
+    blog_id: int, categories: list[schemas.CategoryCreate], db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)
+):
+    user = await auth.get_current_user(token, db)
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
+    if db_blog is None:
+        raise HTTPException(status_code=404, detail="Blog not found")
+    if db_blog.owner_id != user.id:
+        raise HTTPException(
+            status_code=405, detail="Not allowed! you are not the owner of this blog")
+    if len(categories) > BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BULK_MAX_ITEMS} categories per blog")
+    names = [category.name for category in categories]
+    return respond(await run_db(db, crud.set_blog_categories, blog_id=blog_id, names=names, schema=list[schemas.Category]))
 
 
 @router.delete("/blog/{blog_id}/category/{category_id}", response_model=schemas.BlogCategory, tags=["category"])
@@ -66,13 +114,13 @@ async def delete_category_for_blog(
     token: str = Depends(oauth2_scheme)
 ):
     user = await auth.get_current_user(token, db)
-    db_blog = crud.get_blog_by_id(db, blog_id=blog_id)
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
     if db_blog is None:
         raise HTTPException(status_code=404, detail="Blog not found")
     if db_blog.owner_id != user.id:
         raise HTTPException(
             status_code=405, detail="Not allowed! you are not the owner of this blog")
-    if not crud.check_blog_category(db, blog_id, category_id):
+    if not await run_db(db, crud.check_blog_category, blog_id, category_id):
         raise HTTPException(
             status_code=405, detail="This category not found for this blog")
-    return crud.delete_blog_category(db=db, blog_id=blog_id, category_id=category_id)
+    return respond(await run_db(db, crud.delete_blog_category, blog_id=blog_id, category_id=category_id, schema=schemas.BlogCategory))
@@ -1,76 +1,174 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+from fastapi import APIRouter, Body, Depends, Header, Response
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 
-from api.dps import get_db
+from api.dps import (
+    background_session, bulk_result, get_cursor, get_db, get_read_db, release_db, respond, run_db, validate_bulk)
 from api import auth
 from common import schemas, crud
+from common.events import COMMENT_STREAM_KEEPALIVE, Subscription, comment_events, parse_event_id
+from common.pagination import NEXT_CURSOR_HEADER, next_cursor
+from common.writebuffer import (
+    COMMENT_WRITE_BUFFER, COMMENT_WRITE_BUFFER_MAX_ITEMS, COMMENT_WRITE_BUFFER_WINDOW_MS, WriteBuffer)
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+async def _write_comments(comments: list[dict]) -> list[schemas.Comment]:
+    async with background_session() as db:
+        return await run_db(db, crud.create_comments_batch, comments=comments, schema=list[schemas.Comment])
+
+
+# Opt-in: coalesces POST /blog/{blog_id}/comment/ into one INSERT and one
+# commit per window, for bursts of comments on the same posts.
+comment_write_buffer = WriteBuffer(
+    _write_comments, COMMENT_WRITE_BUFFER_WINDOW_MS / 1000, COMMENT_WRITE_BUFFER_MAX_ITEMS
+) if COMMENT_WRITE_BUFFER else None
+
+
 @router.get("/comment/", response_model=list[schemas.Comment], tags=["comment"])
-def read_comments(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    comments = crud.get_comments(db, skip=skip, limit=limit)
-    return comments
+async def read_comments(
+    response: Response, skip: int = 0, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(int)), db: Session = Depends(get_read_db)
+):
+    comments = await run_db(db, crud.get_comments, skip=skip, limit=limit, after=after, schema=list[schemas.Comment])
+    cursor = next_cursor(comments, limit, lambda c: (c.id,))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(comments, response)
 
 
 @router.get("/comment/{id}", response_model=schemas.Comment, tags=["comment"])
-def read_comment(id: int, db: Session = Depends(get_db)):
-    db_comment = crud.get_comment_by_id(db, comment_id=id)
+async def read_comment(id: int, db: Session = Depends(get_read_db)):
+    db_comment = await run_db(db, crud.get_comment_by_id, comment_id=id, schema=schemas.Comment)
     if db_comment is None:
         raise HTTPException(status_code=404, detail="Comment not found")
-    return db_comment
+    return respond(db_comment)
+
+
+async def _not_found_or_not_owner(id: int, db: Session):
+    # Only reached when a write matched no row: tells the two cases apart.
+    if await run_db(db, crud.get_comment_user_id, comment_id=id) is None:
+        raise HTTPException(status_code=404, detail="Comment not found")
+    raise HTTPException(
+        status_code=405, detail="Not allowed! you are not the owner of this comment")
 
 
 @router.put("/comment/{id}", response_model=schemas.Comment, tags=["comment"])
 async def update_comment(id: int, comment: schemas.CommentCreate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = await auth.get_current_user(token, db)
-    db_comment = crud.get_comment_by_id(db, comment_id=id)
+    db_comment = await run_db(db, crud.update_comment, comment_id=id, user_id=user.id, changes=comment.dict(), schema=schemas.Comment)
     if db_comment is None:
-        raise HTTPException(status_code=404, detail="Comment not found")
-    if db_comment.user_id != user.id:
-        raise HTTPException(
-            status_code=405, detail="Not allowed! you are not the owner of this comment")
+        await _not_found_or_not_owner(id, db)
+    return respond(db_comment)
+
 
-    db_comment = crud.update_comment(
-        db, comment_id=id, comment=comment)
-    return db_comment
+@router.patch("/comment/{id}", response_model=schemas.Comment, tags=["comment"])
+async def patch_comment(id: int, comment: schemas.CommentUpdate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    user = await auth.get_current_user(token, db)
+    changes = comment.dict(exclude_unset=True, exclude_none=True)
+    db_comment = await run_db(db, crud.update_comment, comment_id=id, user_id=user.id, changes=changes, schema=schemas.Comment)
+    if db_comment is None:
+        await _not_found_or_not_owner(id, db)
+    return respond(db_comment)
 
 
 @router.delete("/comment/{id}", response_model=schemas.Comment, tags=["comment"])
 async def delete_comment(id: int, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = await auth.get_current_user(token, db)
-    db_comment = crud.get_comment_by_id(db, comment_id=id)
+    db_comment = await run_db(db, crud.delete_comment, comment_id=id, user_id=user.id, schema=schemas.Comment)
     if db_comment is None:
-        raise HTTPException(status_code=404, detail="Comment not found")
-    if db_comment.user_id != user.id:
-        raise HTTPException(
-            status_code=405, detail="Not allowed! you are not the owner of this comment")
+        await _not_found_or_not_owner(id, db)
+    return respond(db_comment)
+
+
+@router.get("/blog/{blog_id}/comment/", response_model=list[schemas.Comment], tags=["comment"], description="Returns a blog's comments, newest first. Pass the `X-Next-Cursor` response header (or the blog's `comments_cursor`) back as `cursor` to fetch the next page.")
+async def read_blog_comments(
+    blog_id: int, response: Response, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(datetime, int)), db: Session = Depends(get_read_db)
+):
+    comments = await run_db(db, crud.get_comments_by_blog_id, blog_id=blog_id, limit=limit, after=after, schema=list[schemas.Comment])
+    cursor = next_cursor(comments, limit, lambda c: (c.created_at, c.id))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(comments, response)
+
+
+async def _event_stream(subscription: Subscription):
+    try:
+        if subscription.reset:
+            yield "event: reset\ndata: {}\n\n"
+        while True:
+            events = await subscription.next(COMMENT_STREAM_KEEPALIVE)
+            if events is None:
+                # Evicted or shutting down; the client reconnects and resumes.
+                break
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            yield "".join(f"id: {event.event_id}\nevent: {event.type}\ndata: {event.data}\n\n" for event in events)
+    finally:
+        comment_events.unsubscribe(subscription)
+
+
+@router.get("/blog/{blog_id}/comment/stream", tags=["comment"], description="Server-sent events for a blog's comments: `created`, `updated` and `deleted`, each carrying the comment. Reconnect with `Last-Event-ID` (or `last_event_id`) to resume; a `reset` event means the gap is too old to replay and the list must be reloaded.")
+async def stream_blog_comments(
+    blog_id: int, last_event_id: str | None = None,
+    last_event_id_header: str | None = Header(None, alias="Last-Event-ID"), db: Session = Depends(get_read_db)
+):
+    last_event_id = last_event_id_header or last_event_id
+    if last_event_id:
+        try:
+            parse_event_id(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    else:
+        last_event_id = None
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
+    if db_blog is None:
+        raise HTTPException(status_code=404, detail="Blog not found")
+    # The stream may stay open for hours; it must not keep a connection.
+    await release_db(db)
+    subscription = comment_events.subscribe(blog_id, last_event_id)
+    return StreamingResponse(
+        _event_stream(subscription), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    db_comment = crud.delete_comment(db, comment_id=id)
-    return db_comment
 
+@router.post("/blog/{blog_id}/comment/", response_model=schemas.Comment, tags=["comment"])
+async def create_comment(blog_id: int, comment: schemas.CommentCreate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    user = await auth.get_current_user(token, db)
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
+    if db_blog is None:
+        raise HTTPException(status_code=404, detail="Blog not found")
 
-@router.get("/blog/{blog_id}/comment/", response_model=schemas.Comment, tags=["comment"])
-def read_comments(blog_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    comments = crud.get_comments_by_blog_id(
-        db, blog_id=blog_id, skip=skip, limit=limit)
-    return comments
+    if comment_write_buffer is not None:
+        # Waiters must not pin pool connections the flush itself needs.
+        await release_db(db)
+        try:
+            db_comment = await comment_write_buffer.submit({**comment.dict(), "blog_id": blog_id, "user_id": user.id})
+        except IntegrityError:
+            # The blog was deleted while the comment sat in the buffer.
+            raise HTTPException(status_code=404, detail="Blog not found")
+        return respond(db_comment)
+    return respond(await run_db(db, crud.create_comment, blog_id=blog_id, user_id=user.id, comment=comment, schema=schemas.Comment))
 
 
-@router.post("/blog/{blog_id}/comment/", response_model=schemas.Comment, tags=["comment"])
-async def create_comment(blog_id: int, comment: schemas.CommentCreate, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+@router.post("/blog/{blog_id}/comment/bulk", response_model=schemas.BulkResult, tags=["comment"])
+async def create_comments_bulk(blog_id: int, items: list = Body(...), token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     user = await auth.get_current_user(token, db)
-    db_blog = crud.get_blog_by_id(db, blog_id=blog_id)
+    db_blog = await run_db(db, crud.get_blog_by_id, blog_id=blog_id)
     if db_blog is None:
         raise HTTPException(status_code=404, detail="Blog not found")
 
-    db_comment = crud.create_comment(
-        db=db, blog_id=blog_id, user_id=user.id, comment=comment)
-    return db_comment
+    indexes, comments, errors = validate_bulk(schemas.CommentCreate, items)
+    ids = await run_db(db, crud.create_comments_bulk, blog_id=blog_id, user_id=user.id, comments=comments)
+    return bulk_result(indexes, ids, errors)
@@ -1,11 +1,218 @@
-from common.database import SessionLocal
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError, parse_obj_as
+
+from common import database
+from common.database import DB_STICKY_SECONDS, ReadSessionLocal, SessionLocal
+from common import schemas, serializers
+from common.cache import CacheEntry
+from common.pagination import InvalidCursor, decode_cursor
+
+
+_recent_writers: dict[str, float] = {}
+_recent_writers_lock = threading.Lock()
+
+
+def _client_key(request: Request) -> str:
+    return request.headers.get("authorization") or (request.client.host if request.client else "")
+
+
+def _mark_writer(request: Request):
+    if request.method in ("GET", "HEAD", "OPTIONS"):
+        return
+    now = time.monotonic()
+    with _recent_writers_lock:
+        _recent_writers[_client_key(request)] = now + DB_STICKY_SECONDS
+        if len(_recent_writers) > 10000:
+            for key in [key for key, until in _recent_writers.items() if until <= now]:
+                del _recent_writers[key]
+
+
+def _is_recent_writer(request: Request) -> bool:
+    return _recent_writers.get(_client_key(request), 0) > time.monotonic()
 
 
 # Dependency
 
-def get_db():
+def _get_sync_db(request: Request):
+    _mark_writer(request)
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+async def _get_async_db(request: Request):
+    _mark_writer(request)
+    async with database.AsyncSessionLocal() as db:
+        yield db
+
+
+def _get_sync_read_db(request: Request):
+    db = SessionLocal() if _is_recent_writer(request) else ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def _get_async_read_db(request: Request):
+    session = database.AsyncSessionLocal if _is_recent_writer(request) else database.AsyncReadSessionLocal
+    async with session() as db:
+        yield db
+
+
+def from_replica(db) -> bool:
+    return bool(db.info.get("replica"))
+
+
+async def release_db(db):
+    # Hands the session's connection back to the pool before a long wait;
+    # the session checks out a fresh one if it is used again.
+    if database.DATABASE_ASYNC:
+        await db.close()
+    else:
+        await run_in_threadpool(db.close)
+
+
+@asynccontextmanager
+async def background_session():
+    # A primary session for work done outside any one request.
+    if database.DATABASE_ASYNC:
+        async with database.AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+get_db = _get_async_db if database.DATABASE_ASYNC else _get_sync_db
+# Read-only routes: a replica, unless this client wrote within the last
+# DB_STICKY_SECONDS and must read its own writes from the primary.
+get_read_db = _get_async_read_db if database.DATABASE_ASYNC else _get_sync_read_db
+
+
+async def run_db(db, fn, *args, schema=None, **kwargs):
+    # Runs a sync crud function without blocking the event loop: on an
+    # AsyncSession through run_sync, otherwise in the threadpool. When a
+    # schema is given the result is serialised there too, so relationship
+    # loads never happen on the event loop.
+    def call(session):
+        result = fn(session, *args, **kwargs)
+        if schema is None or result is None:
+            return result
+        if serializers.FAST_SERIALIZATION:
+            return serializers.trusted(schema, result)
+        return parse_obj_as(schema, result)
+
+    if database.DATABASE_ASYNC:
+        return await db.run_sync(call)
+    return await run_in_threadpool(call, db)
+
+
+BULK_MAX_ITEMS = 1000
+
+
+def validate_bulk(schema, items: list) -> tuple[list[int], list, list[schemas.BulkItemError]]:
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per request")
+    indexes, valid, errors = [], [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append(schema.parse_obj(item))
+            indexes.append(index)
+        except ValidationError as e:
+            errors.append(schemas.BulkItemError(index=index, errors=e.errors()))
+    return indexes, valid, errors
+
+
+def bulk_result(indexes: list[int], ids: list[int], errors: list[schemas.BulkItemError]) -> schemas.BulkResult:
+    created = [schemas.BulkCreated(index=index, id=id) for index, id in zip(indexes, ids)]
+    return schemas.BulkResult(created=created, errors=errors)
+
+
+def get_cursor(*types):
+    def dependency(cursor: str | None = None):
+        if cursor is None:
+            return None
+        try:
+            return decode_cursor(cursor, *types)
+        except InvalidCursor:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return dependency
+
+
+def _encode(value) -> bytes:
+    if serializers.FAST_SERIALIZATION:
+        return serializers.dumps(value)
+    # Same encoding as fastapi's JSONResponse, so cached and uncached
+    # bodies are byte-identical.
+    return json.dumps(
+        jsonable_encoder(value), ensure_ascii=False, allow_nan=False,
+        indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def respond(value, response: Response | None = None):
+    # With FAST_SERIALIZATION the value was built by serializers.trusted
+    # from our own rows, so fastapi's response validation and
+    # jsonable_encoder pass are skipped and it is encoded directly.
+    # Headers set on the route's injected `response` are carried over.
+    if not serializers.FAST_SERIALIZATION or isinstance(value, Response):
+        return value
+    rendered = Response(_encode(value), media_type="application/json")
+    if response is not None:
+        for name, header in response.headers.items():
+            if name != "content-length":
+                rendered.headers[name] = header
+    return rendered
+
+
+def cache_entry(value, last_modified: datetime | None = None, headers: dict | None = None) -> CacheEntry:
+    return CacheEntry.from_body(_encode(value), last_modified, headers)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def _not_modified_since(if_modified_since: str | None, last_modified: datetime) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        # "-0000" zones parse as naive; HTTP dates are always GMT.
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP dates have whole seconds.
+    return last_modified.astimezone(timezone.utc).replace(microsecond=0) <= since
+
+
+def render_cached(request: Request, entry: CacheEntry, media_type: str = "application/json") -> Response:
+    headers = {"ETag": entry.etag, **entry.headers}
+    if entry.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(
+            entry.last_modified.astimezone(timezone.utc), usegmt=True)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if _etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+    elif entry.last_modified is not None and _not_modified_since(
+            request.headers.get("if-modified-since"), entry.last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type=media_type, headers=headers)
@@ -0,0 +1,39 @@
+import json
+from datetime import datetime
+from enum import Enum
+
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+
+from common import crud
+from common.database import ReadSessionLocal
+
+router = APIRouter()
+
+
+class ExportEntity(str, Enum):
+    blogs = "blogs"
+    comments = "comments"
+    users = "users"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _ndjson(entity: str, updated_since: datetime | None):
+    # Runs in the threadpool as the response is sent, with its own replica
+    # session so the cursor stays open exactly as long as the stream.
+    with ReadSessionLocal() as db:
+        for rows in crud.stream_export(db, entity, updated_since=updated_since):
+            yield "".join(
+                json.dumps(row, ensure_ascii=False, default=_json_default) + "\n" for row in rows
+            ).encode("utf-8")
+
+
+@router.get("/export/{entity}", tags=["export"], description="Streams every row as newline-delimited JSON. `updated_since` limits it to rows changed (for users: joined) since then.")
+def export_entity(entity: ExportEntity, updated_since: datetime | None = None):
+    return StreamingResponse(
+        _ndjson(entity.value, updated_since), media_type="application/x-ndjson")
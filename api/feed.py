@@ -0,0 +1,68 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.exceptions import HTTPException
+
+from sqlalchemy.orm import Session
+
+
+from api.dps import get_read_db, render_cached, run_db
+from common import crud
+from common.cache import CacheEntry, response_cache
+from common.feeds import FEED_SIZE, SITE_URL, render_atom, render_sitemap_index, render_urlset
+
+router = APIRouter()
+
+ATOM_MEDIA_TYPE = "application/atom+xml"
+XML_MEDIA_TYPE = "application/xml"
+
+
+def _site_url(request: Request) -> str:
+    return SITE_URL or str(request.base_url).rstrip("/")
+
+
+async def _render_versioned(request: Request, key: str, version, render, media_type: str):
+    # Bodies are keyed by the snapshot version, so each one is rendered
+    # once per change rather than once per poll, and never goes stale.
+    key = f"{key}:{version.isoformat() if version else ''}:{_site_url(request)}"
+    entry = response_cache.get(key)
+    if entry is None:
+        entry = CacheEntry.from_body(await render(), last_modified=version)
+        response_cache.set(key, entry)
+    return render_cached(request, entry, media_type=media_type)
+
+
+@router.get("/feed.atom", tags=["feed"], description="Atom feed of the latest blogs.")
+async def read_feed(request: Request, db: Session = Depends(get_read_db)):
+    version = await run_db(db, crud.get_feed_version)
+
+    async def render():
+        entries = await run_db(db, crud.get_feed_entries, limit=FEED_SIZE)
+        return render_atom(_site_url(request), entries, version)
+
+    return await _render_versioned(request, "feed", version, render, ATOM_MEDIA_TYPE)
+
+
+@router.get("/sitemap.xml", tags=["feed"], description="Sitemap of every blog; a sitemap index once there is more than one shard.")
+async def read_sitemap(request: Request, db: Session = Depends(get_read_db)):
+    shards = await run_db(db, crud.get_sitemap_shards)
+    if len(shards) == 1:
+        return await read_sitemap_shard(shards[0].shard, request, db)
+    version = max((shard.lastmod for shard in shards), default=None)
+
+    async def render():
+        if not shards:
+            return render_urlset(_site_url(request), [])
+        return render_sitemap_index(_site_url(request), shards)
+
+    return await _render_versioned(request, "sitemap", version, render, XML_MEDIA_TYPE)
+
+
+@router.get("/sitemap-{shard}.xml", tags=["feed"], description="One shard of the sitemap.")
+async def read_sitemap_shard(shard: int, request: Request, db: Session = Depends(get_read_db)):
+    shards = {row.shard: row for row in await run_db(db, crud.get_sitemap_shards)}
+    if shard not in shards:
+        raise HTTPException(status_code=404, detail="Sitemap not found")
+
+    async def render():
+        return render_urlset(_site_url(request), await run_db(db, crud.get_sitemap_urls, shard=shard))
+
+    return await _render_versioned(request, f"sitemap-{shard}", shards[shard].lastmod, render, XML_MEDIA_TYPE)
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+
+from api.comment import comment_write_buffer
+from common.admission import ADMISSION_CONTROL, admission
+
+from common.cache import response_cache
+from common.events import comment_events
+from common.principals import principal_cache
+from common.security import password_hash_queue_depth
+from common.trending import activity
+
+router = APIRouter()
+
+
+@router.get("/metrics", tags=["metrics"], description="Returns in-process cache and queue counters.")
+async def read_metrics():
+    return {
+        "principal_cache": principal_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "password_hash_queue_depth": password_hash_queue_depth(),
+        "comment_write_buffer": comment_write_buffer.stats() if comment_write_buffer else None,
+        "admission": admission.stats() if ADMISSION_CONTROL else None,
+        "activity": activity.stats(),
+        "comment_streams": comment_events.stats(),
+    }
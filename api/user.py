@@ -1,12 +1,15 @@
+from datetime import datetime
 from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 
 from api.auth import get_current_user
-from api.dps import get_db
+from api.dps import get_cursor, get_db, get_read_db, respond, run_db
 
 from common import schemas, crud
+from common.security import PasswordHasherBusy, get_password_hash_async
+from common.pagination import NEXT_CURSOR_HEADER, next_cursor
 
 router = APIRouter()
 
@@ -14,37 +17,63 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 @router.post("/user/", response_model=schemas.User, tags=["user"], description="Create a new user")
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    db_user = await run_db(db, crud.get_user_by_username, username=user.username)
     if db_user:
         raise HTTPException(
             status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    try:
+        hashed_password = await get_password_hash_async(user.password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=503, detail="Too many sign-ups in progress, please retry",
+            headers={"Retry-After": "1"})
+    return respond(await run_db(db, crud.create_user, user=user, hashed_password=hashed_password, schema=schemas.User))
 
 
 @router.get("/user/", response_model=list[schemas.User], tags=["user"], description="Returns a list of users.")
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+async def read_users(
+    response: Response, skip: int = 0, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(int)), db: Session = Depends(get_read_db)
+):
+    users = await run_db(db, crud.get_users, skip=skip, limit=limit, after=after, schema=list[schemas.User])
+    cursor = next_cursor(users, limit, lambda u: (u.id,))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(users, response)
 
 
 @router.get("/user/{username}", response_model=schemas.User, tags=["user"], description="Returns a user. (by username)")
-def read_user(username: str, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, username=username)
+async def read_user(username: str, db: Session = Depends(get_read_db)):
+    db_user = await run_db(db, crud.get_user_by_username, username=username, schema=schemas.User)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    return respond(db_user)
+
+
+@router.get("/user/{username}/blog/", response_model=list[schemas.BlogSummary], tags=["user"], description="Returns a user's blogs, most recently updated first. Pass the `X-Next-Cursor` response header back as `cursor` to fetch the next page.")
+async def read_user_blogs(
+    username: str, response: Response, limit: int = 100,
+    after: tuple | None = Depends(get_cursor(datetime, int)), db: Session = Depends(get_read_db)
+):
+    blogs = await run_db(db, crud.get_blogs_by_owner, username=username, limit=limit, after=after, schema=list[schemas.BlogSummary])
+    if blogs is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    cursor = next_cursor(blogs, limit, lambda b: (b.updated_at, b.id))
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return respond(blogs, response)
 
 
 @router.get("/userId/{user_id}", response_model=schemas.User, tags=["user"], description="Returns a user. (by user_id)")
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user(user_id: int, db: Session = Depends(get_read_db)):
+    db_user = await run_db(db, crud.get_user, user_id=user_id, schema=schemas.User)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    return respond(db_user)
 
 
 @router.get("/my-account/", response_model=schemas.User, tags=["user"], description="Returns the current user.")
-async def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
     current_user = await get_current_user(token, db)
-    return current_user
+    return respond(await run_db(db, crud.get_user, user_id=current_user.id, schema=schemas.User))
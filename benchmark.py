@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Concurrent throughput of the app in sync (threadpool) and AsyncSession
+# (DATABASE_ASYNC=1) mode, against the configured database:
+#
+#   python benchmark.py --requests 2000 --concurrency 64 --path /blog/ --path /user/
+#
+# Each mode runs in its own process, since the mode is fixed at import.
+# Requests go straight into the ASGI app, so only the app and the database
+# are measured. "loop lag" is the longest the event loop was kept from
+# running a 1 ms ticker: it is what every other in-flight request waits
+# on when a handler blocks the loop.
+
+MODES = {"sync": "0", "async": "1"}
+
+
+async def _request(app, path: str) -> int:
+    status = 0
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"host", b"benchmark")],
+        "client": ("127.0.0.1", 0), "server": ("benchmark", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def _measure_lag(stop: asyncio.Event) -> float:
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - started - 0.001)
+    return worst
+
+
+async def _run(paths: list[str], requests: int, concurrency: int) -> dict:
+    from main import app
+
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for n in range(requests):
+        queue.put_nowait(paths[n % len(paths)])
+
+    async def client():
+        nonlocal errors
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            if await _request(app, path) >= 400:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    for path in paths:
+        # Warm up pools and caches outside the measurement.
+        await _request(app, path)
+    stop = asyncio.Event()
+    lag = asyncio.create_task(_measure_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "loop_lag_ms": await lag * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--path", action="append", dest="paths")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    paths = args.paths or ["/blog/", "/user/", "/comment/"]
+
+    if args.mode:
+        print(json.dumps(asyncio.run(_run(paths, args.requests, args.concurrency))))
+        return
+
+    for mode, flag in MODES.items():
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--requests", str(args.requests),
+             "--concurrency", str(args.concurrency), *(f"--path={path}" for path in paths)],
+            env={**os.environ, "DATABASE_ASYNC": flag}, check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:6} {result['rps']:8.0f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p99 {result['p99_ms']:7.2f} ms  loop lag {result['loop_lag_ms']:7.2f} ms  "
+              f"errors {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
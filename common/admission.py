@@ -0,0 +1,159 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "").lower() in ("1", "true", "yes")
+# Seconds a request may wait for a slot before it is shed with a 503.
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5))
+# group=concurrency:queue, comma-separated; unlisted groups keep the defaults.
+ADMISSION_LIMITS = os.environ.get("ADMISSION_LIMITS", "")
+# Streams hold their slot for as long as the client stays connected, so
+# they get their own group and are never queued.
+DEFAULT_LIMITS = {
+    "reads": (64, 256), "writes": (16, 64), "auth": (8, 32), "export": (2, 4), "streams": (1024, 0)}
+
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 20))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 40))
+RATE_LIMIT_CLIENTS = int(os.environ.get("RATE_LIMIT_CLIENTS", 10000))
+
+# Never limited, so the service can still be observed while it sheds load.
+EXEMPT_PATHS = ("/", "/metrics", "/docs", "/openapi.json")
+
+
+def parse_limits(spec: str) -> dict[str, tuple[int, int]]:
+    limits = dict(DEFAULT_LIMITS)
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        group, _, values = part.partition("=")
+        concurrency, _, queue = values.partition(":")
+        limits[group.strip()] = (int(concurrency), int(queue or 0))
+    return limits
+
+
+def route_group(method: str, path: str) -> str | None:
+    if path in EXEMPT_PATHS:
+        return None
+    # Logins, refreshes and logouts share one bulkhead with sign-ups.
+    if path == "/token" or path.startswith("/token/") or (method == "POST" and path == "/user/"):
+        return "auth"
+    if path.startswith("/export/"):
+        return "export"
+    if path.endswith("/stream"):
+        return "streams"
+    if method in ("GET", "HEAD", "OPTIONS"):
+        return "reads"
+    return "writes"
+
+
+class Bulkhead:
+    # At most `limit` requests of a group run at once and at most
+    # `queue_limit` wait for a slot; everything past that is turned away
+    # at once instead of piling up in memory.
+
+    def __init__(self, limit: int, queue_limit: int, timeout: float):
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.active = 0
+        self.rejected = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_limit:
+            self.rejected += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            self._abandon(future)
+            raise
+        if future.done() and not future.cancelled():
+            return True
+        self._abandon(future)
+        self.rejected += 1
+        return False
+
+    def _abandon(self, future: asyncio.Future):
+        if future.done() and not future.cancelled():
+            # Handed a slot just as we gave up on it; pass it on.
+            self.release()
+            return
+        future.cancel()
+        try:
+            self._waiters.remove(future)
+        except ValueError:
+            pass
+
+    def release(self):
+        # A freed slot goes straight to the oldest waiter, so `active`
+        # only drops when nobody is queued.
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active, "queued": len(self._waiters), "limit": self.limit,
+            "queue_limit": self.queue_limit, "rejected": self.rejected,
+        }
+
+
+class RateLimiter:
+    # Token bucket per client: `rate` requests per second sustained, up to
+    # `burst` at once. Least recently seen clients are forgotten first.
+
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.limited = 0
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def take(self, key: str) -> int:
+        # 0 when the request may proceed, else the seconds until it could.
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = max(1, math.ceil((1 - tokens) / self.rate))
+            self.limited += 1
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {"clients": len(self._buckets), "limited": self.limited}
+
+
+class AdmissionController:
+    def __init__(self, limits: dict[str, tuple[int, int]], timeout: float, rate_limiter: RateLimiter):
+        self.bulkheads = {
+            group: Bulkhead(concurrency, queue, timeout) for group, (concurrency, queue) in limits.items()}
+        self.rate_limiter = rate_limiter
+
+    def stats(self) -> dict:
+        return {
+            "groups": {group: bulkhead.stats() for group, bulkhead in self.bulkheads.items()},
+            "rate_limit": self.rate_limiter.stats(),
+        }
+
+
+admission = AdmissionController(
+    parse_limits(ADMISSION_LIMITS), ADMISSION_QUEUE_TIMEOUT,
+    RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_CLIENTS))
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+
+
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 300))
+# Seconds after an invalidation during which a body read from a replica is
+# served but not stored: the replica may not have the write yet, and
+# caching its answer would hand the old data to every client until the
+# TTL. Defaults to the read-your-writes window, DB_STICKY_SECONDS.
+RESPONSE_CACHE_REPLICA_HOLD = float(
+    os.environ.get("RESPONSE_CACHE_REPLICA_HOLD", os.environ.get("DB_STICKY_SECONDS", 5)))
+
+
+class CacheBackend:
+    # The subset of the redis-py client API the response cache relies on,
+    # so a redis.Redis instance or any compatible stand-in can be plugged in.
+
+    def get(self, name: str) -> bytes | None:
+        raise NotImplementedError
+
+    def set(self, name: str, value: bytes, ex: int | None = None):
+        raise NotImplementedError
+
+    def delete(self, *names: str):
+        raise NotImplementedError
+
+    def incr(self, name: str) -> int:
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[bytes, float | None]] = OrderedDict()
+        # Counters live outside the LRU; evicting one would resurrect stale pages.
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> bytes | None:
+        with self._lock:
+            if name in self._counters:
+                return str(self._counters[name]).encode()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                del self._entries[name]
+                return None
+            self._entries.move_to_end(name)
+            return entry[0]
+
+    def set(self, name: str, value: bytes, ex: int | None = None):
+        expires_at = time.time() + ex if ex else None
+        with self._lock:
+            self._entries[name] = (value, expires_at)
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *names: str):
+        with self._lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+    def incr(self, name: str) -> int:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+
+def create_backend(url: str | None) -> CacheBackend:
+    if not url:
+        return MemoryCache(RESPONSE_CACHE_SIZE)
+    import redis
+    return redis.Redis.from_url(url)
+
+
+@dataclass
+class CacheEntry:
+    body: bytes
+    etag: str
+    last_modified: datetime | None = None
+    headers: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_body(cls, body: bytes, last_modified: datetime | None = None, headers: dict | None = None):
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        return cls(body, etag, last_modified, headers or {})
+
+    def encode(self) -> bytes:
+        return json.dumps({
+            "body": self.body.decode(),
+            "etag": self.etag,
+            "last_modified": self.last_modified.isoformat() if self.last_modified else None,
+            "headers": self.headers,
+        }).encode()
+
+    @classmethod
+    def decode(cls, raw: bytes):
+        data = json.loads(raw)
+        last_modified = data["last_modified"]
+        return cls(
+            data["body"].encode(), data["etag"],
+            datetime.fromisoformat(last_modified) if last_modified else None,
+            data["headers"])
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> CacheEntry | None:
+        raw = self.backend.get(key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CacheEntry.decode(raw)
+
+    def set(self, key: str, entry: CacheEntry, ttl: int | None = None, from_replica: bool = False):
+        if from_replica and self._held(key):
+            return
+        self.backend.set(key, entry.encode(), ex=ttl or self.ttl)
+
+    # A held key (or listing namespace) was invalidated within the last
+    # RESPONSE_CACHE_REPLICA_HOLD seconds.
+    def _hold(self, name: str):
+        if RESPONSE_CACHE_REPLICA_HOLD > 0:
+            self.backend.set(f"held:{name}", b"1", ex=math.ceil(RESPONSE_CACHE_REPLICA_HOLD))
+
+    def _held(self, key: str) -> bool:
+        return any(self.backend.get(f"held:{name}") is not None for name in (key, key.partition(":")[0]))
+
+    # List pages are keyed under a generation counter, so one increment
+    # retires every page of a listing without having to enumerate them.
+    def _list_key(self, namespace: str, *params) -> str:
+        generation = self.backend.get(f"{namespace}:gen") or b"0"
+        return ":".join([namespace, generation.decode(), *map(str, params)])
+
+    def blog_key(self, blog_id: int) -> str:
+        return f"blog:{blog_id}"
+
+    def blog_list_key(self, *params) -> str:
+        return self._list_key("blog-list", *params)
+
+    def blog_categories_key(self, blog_id: int) -> str:
+        return f"blog-categories:{blog_id}"
+
+    def category_list_key(self, *params) -> str:
+        return self._list_key("category-list", *params)
+
+    def trending_key(self, *params) -> str:
+        return self._list_key("trending", *params)
+
+    def invalidate_blog(self, blog_id: int):
+        self.backend.delete(self.blog_key(blog_id))
+        self._hold(self.blog_key(blog_id))
+
+    def invalidate_blog_lists(self):
+        self.backend.incr("blog-list:gen")
+        self._hold("blog-list")
+
+    def invalidate_blog_categories(self, blog_id: int):
+        self.backend.delete(self.blog_categories_key(blog_id))
+        self._hold(self.blog_categories_key(blog_id))
+
+    def invalidate_category_lists(self):
+        self.backend.incr("category-list:gen")
+        self._hold("category-list")
+
+    def invalidate_trending(self):
+        self.backend.incr("trending:gen")
+        self._hold("trending")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+response_cache = ResponseCache(
+    create_backend(RESPONSE_CACHE_URL), RESPONSE_CACHE_TTL)
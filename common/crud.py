@@ -1,8 +1,29 @@
 import datetime
+import os
+from collections import Counter
+from types import SimpleNamespace
+from sqlalchemy import Integer, bindparam, column, delete, func, insert, literal, select, tuple_, update, values
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
-from common.security import get_password_hash
+from common.security import get_password_hash, hash_refresh_token, new_refresh_token
+from common.principals import principal_cache
+from common.cache import response_cache
+from common.events import comment_events
+from common.search import search_index
+from common.trending import (
+    TRENDING_COMMENT_WEIGHT, activity, add_activity, current_score, min_log_score)
 
-from . import models, schemas
+from . import models, rendering, schemas, serializers
+from .feeds import SITEMAP_SHARD_SIZE, shard_of
+from .pagination import encode_cursor
+
+BLOG_DETAIL_COMMENTS = int(os.environ.get("BLOG_DETAIL_COMMENTS", 20))
+
+
+def columns_for(schema, model) -> list:
+    # Projection derived from the response schema, so a field added there
+    # is selected here too; relationships are left to the caller.
+    return [getattr(model, name) for name in schema.__fields__ if name in model.__table__.c]
 
 
 def get_user(db: Session, user_id: int):
@@ -13,14 +34,20 @@ def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_users(db: Session, skip: int = 0, limit: int = 100, after: tuple | None = None):
+    query = db.query(*columns_for(schemas.User, models.User)).order_by(models.User.id)
+    if after is not None:
+        query = query.filter(models.User.id > after[0])
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed = get_password_hash(user.password)
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: str | None = None):
+    if hashed_password is None:
+        hashed_password = get_password_hash(user.password)
     db_user = models.User(
-        username=user.username, hashed_password=hashed)
+        username=user.username, hashed_password=hashed_password)
     db_user.joined_at = datetime.datetime.now()
     db.add(db_user)
     db.commit()
@@ -28,52 +55,452 @@ def create_user(db: Session, user: schemas.UserCreate):
     return db_user
 
 
-def get_blogs(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Blog).offset(skip).limit(limit).all()
+def _add_refresh_token(
+    db: Session, user_id: int, family_id: str, expires_at: datetime.datetime, family_expires_at: datetime.datetime
+) -> str:
+    token = new_refresh_token()
+    db.add(models.RefreshToken(
+        token_hash=hash_refresh_token(token), family_id=family_id, user_id=user_id,
+        created_at=datetime.datetime.now(), expires_at=expires_at, family_expires_at=family_expires_at))
+    return token
+
+
+def create_refresh_token(db: Session, user_id: int, expires_in: datetime.timedelta) -> str:
+    expires_at = datetime.datetime.now() + expires_in
+    token = _add_refresh_token(db, user_id, new_refresh_token(), expires_at, expires_at)
+    db.commit()
+    return token
+
+
+def rotate_refresh_token(db: Session, token: str, expires_in: datetime.timedelta):
+    # Returns (username, new refresh token), or None when the token is not
+    # valid. One indexed lookup; the row lock makes concurrent refreshes
+    # with the same token see each other's rotation.
+    now = datetime.datetime.now()
+    db_token = db.query(models.RefreshToken).filter(
+        models.RefreshToken.token_hash == hash_refresh_token(token)).with_for_update().first()
+    if db_token is None or db_token.revoked_at is not None or db_token.expires_at <= now:
+        return None
+    if db_token.used_at is not None:
+        # Already rotated, so two parties hold this family: revoke it all
+        # and make the user log in again.
+        _revoke_refresh_family(db, db_token.family_id, now)
+        db.commit()
+        return None
+    db_token.used_at = now
+    # The new token lives at most as long as the login it came from.
+    family_expires_at = db_token.family_expires_at or db_token.expires_at
+    new_token = _add_refresh_token(
+        db, db_token.user_id, db_token.family_id, min(now + expires_in, family_expires_at), family_expires_at)
+    username = db.query(models.User.username).filter(models.User.id == db_token.user_id).scalar()
+    db.commit()
+    return username, new_token
+
+
+def _revoke_refresh_family(db: Session, family_id: str, now: datetime.datetime):
+    db.query(models.RefreshToken).filter(
+        models.RefreshToken.family_id == family_id, models.RefreshToken.revoked_at.is_(None)
+    ).update({models.RefreshToken.revoked_at: now}, synchronize_session=False)
+
+
+def purge_refresh_tokens(db: Session) -> int:
+    # Rows of expired or revoked families can no longer be exchanged, and
+    # presenting one fails the same way once it is gone. Used rows of live
+    # families stay, to detect their reuse.
+    now = datetime.datetime.now()
+    table = models.RefreshToken.__table__
+    deleted = db.execute(delete(table).where(
+        (func.coalesce(table.c.family_expires_at, table.c.expires_at) <= now) | table.c.revoked_at.is_not(None)
+    )).rowcount
+    db.commit()
+    return deleted
+
+
+def revoke_refresh_token(db: Session, token: str) -> bool:
+    family_id = db.query(models.RefreshToken.family_id).filter(
+        models.RefreshToken.token_hash == hash_refresh_token(token)).scalar()
+    if family_id is None:
+        return False
+    _revoke_refresh_family(db, family_id, datetime.datetime.now())
+    db.commit()
+    return True
+
+
+def _adjust_user_counts(db: Session, user_id: int, blogs: int = 0, comments: int = 0, posted_at=None):
+    values = {}
+    if blogs:
+        values["blog_count"] = models.User.blog_count + blogs
+    if comments:
+        values["comment_count"] = models.User.comment_count + comments
+    if posted_at is not None:
+        values["last_posted_at"] = posted_at
+    elif blogs < 0:
+        # The latest post may be the one just deleted.
+        values["last_posted_at"] = select(func.max(models.Blog.created_at)).where(
+            models.Blog.owner_id == user_id).scalar_subquery()
+    if values:
+        db.execute(update(models.User).where(models.User.id == user_id).values(**values))
+
+
+def get_blogs_by_owner(db: Session, username: str, limit: int = 100, after: tuple | None = None):
+    # Newest first, seeking on ix_blogs_owner_id_updated_at_id. None when
+    # there is no such user.
+    owner_id = db.query(models.User.id).filter(models.User.username == username).scalar()
+    if owner_id is None:
+        return None
+    query = db.query(*columns_for(schemas.BlogSummary, models.Blog)).filter(
+        models.Blog.owner_id == owner_id).order_by(models.Blog.updated_at.desc(), models.Blog.id.desc())
+    if after is not None:
+        query = query.filter(tuple_(models.Blog.updated_at, models.Blog.id) < tuple_(*after))
+    return query.limit(limit).all()
+
+
+def update_user_password_hash(db: Session, user_id: int, hashed_password: str):
+    db.query(models.User).filter(models.User.id == user_id).update(
+        {models.User.hashed_password: hashed_password}, synchronize_session=False)
+    db.commit()
+    principal_cache.invalidate_user(user_id)
+
+
+def get_blogs(db: Session, skip: int = 0, limit: int = 100, after: tuple | None = None):
+    query = db.query(*columns_for(schemas.BlogSummary, models.Blog)).order_by(
+        models.Blog.updated_at.desc(), models.Blog.id.desc())
+    if after is not None:
+        query = query.filter(
+            tuple_(models.Blog.updated_at, models.Blog.id) < tuple_(*after))
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
 def get_blog_by_id(db: Session, blog_id: int):
     return db.query(models.Blog).filter(models.Blog.id == blog_id).first()
 
 
+def get_blog_detail(db: Session, blog_id: int):
+    blog = db.query(*columns_for(schemas.Blog, models.Blog)).filter(models.Blog.id == blog_id).first()
+    if blog is None:
+        return None
+    return _with_latest_comments(db, blog)
+
+
+def _with_latest_comments(db: Session, blog):
+    # Only the latest comments are embedded, read off the
+    # (blog_id, created_at, id) index, plus a cursor to the rest.
+    comments = get_comments_by_blog_id(db, blog.id, limit=BLOG_DETAIL_COMMENTS)
+    cursor = None
+    if blog.comment_count > len(comments) and comments:
+        cursor = encode_cursor(comments[-1].created_at, comments[-1].id)
+    return {**blog._asdict(), "comments": comments, "comments_cursor": cursor}
+
+
 def create_blog(db: Session, owner_id: int, blog: schemas.BlogCreate):
     db_blog = models.Blog(**blog.dict(), owner_id=owner_id)
     db_blog.created_at = datetime.datetime.now()
     db_blog.updated_at = datetime.datetime.now()
+    search_index.index(db, db_blog)
     db.add(db_blog)
+    db.flush()
+    store_blog_renditions(db, [(db_blog.id, db_blog.content)])
+    _adjust_user_counts(db, owner_id, blogs=1, posted_at=db_blog.created_at)
+    _touch_sitemap(db, [db_blog.id], 1)
     db.commit()
     db.refresh(db_blog)
+    response_cache.invalidate_blog_lists()
     return db_blog
 
 
-def update_blog(db: Session, blog_id: int, blog: schemas.BlogCreate):
-    db_blog = db.query(models.Blog).filter(models.Blog.id == blog_id).first()
-    db_blog.title = blog.title
-    db_blog.description = blog.description
-    db_blog.content = blog.content
-    db_blog.updated_at = datetime.datetime.now()
+def store_blog_renditions(db: Session, blogs: list[tuple[int, str]]):
+    # Renders and compresses (blog_id, content) pairs once, at write time,
+    # replacing whatever was stored for them before.
+    table = models.BlogRendition.__table__
+    db.execute(delete(table).where(table.c.blog_id.in_([blog_id for blog_id, _ in blogs])))
+    rows = [
+        {"blog_id": blog_id, **rendition}
+        for blog_id, content in blogs for rendition in rendering.renditions(content)]
+    if rows:
+        db.execute(insert(table), rows)
+
+
+def get_blog_rendition(db: Session, blog_id: int, format: str, encoding: str):
+    row = db.execute(
+        select(models.BlogRendition.body, models.BlogRendition.encoding, models.Blog.updated_at,
+               literal(True).label("stored"))
+        .join(models.Blog, models.Blog.id == models.BlogRendition.blog_id)
+        .where(models.BlogRendition.blog_id == blog_id, models.BlogRendition.format == format,
+               models.BlogRendition.encoding == encoding)
+    ).first()
+    if row is not None:
+        return row
+    # Written before renditions existed and not backfilled yet: render just
+    # this format, uncompressed, and leave the expensive compression to
+    # store_missing_renditions.
+    blog = db.execute(
+        select(models.Blog.content, models.Blog.updated_at).where(models.Blog.id == blog_id)).first()
+    if blog is None:
+        return None
+    return SimpleNamespace(
+        body=rendering.render(format, blog.content), encoding="identity", updated_at=blog.updated_at, stored=False)
+
+
+def store_missing_renditions(db: Session, blog_id: int):
+    exists = db.query(models.BlogRendition.blog_id).filter(models.BlogRendition.blog_id == blog_id).first()
+    content = db.query(models.Blog.content).filter(models.Blog.id == blog_id).first()
+    if exists is None and content is not None:
+        store_blog_renditions(db, [(blog_id, content.content)])
+        db.commit()
+
+
+def backfill_blog_renditions(db: Session, everything: bool = False, batch_size: int = 500) -> int:
+    query = select(models.Blog.id, models.Blog.content).order_by(models.Blog.id)
+    if not everything:
+        query = query.where(~select(models.BlogRendition.blog_id).where(
+            models.BlogRendition.blog_id == models.Blog.id).exists())
+    count, after = 0, 0
+    while True:
+        batch = db.execute(query.where(models.Blog.id > after).limit(batch_size)).all()
+        if not batch:
+            return count
+        store_blog_renditions(db, [(blog.id, blog.content) for blog in batch])
+        db.commit()
+        count += len(batch)
+        after = batch[-1].id
+
+
+def _insert_returning(db: Session, table, rows: list[dict], *returning, extra_columns: dict | None = None):
+    # Executed as executemany, which SQLAlchemy batches into multi-row
+    # INSERT ... VALUES (...), (...) RETURNING statements; rows come back
+    # in parameter order.
+    columns = {name: bindparam(name) for name in rows[0] if name in table.c}
+    statement = insert(table).values(**columns, **(extra_columns or {})).returning(
+        *returning, sort_by_parameter_order=True)
+    return db.execute(statement, rows)
+
+
+def _insert_returning_ids(db: Session, table, rows: list[dict], extra_columns: dict | None = None) -> list[int]:
+    return list(_insert_returning(db, table, rows, table.c.id, extra_columns=extra_columns).scalars())
+
+
+def create_blogs_bulk(db: Session, owner_id: int, blogs: list[schemas.BlogCreate]) -> list[int]:
+    if not blogs:
+        return []
+    now = datetime.datetime.now()
+    rows = [{**blog.dict(), "owner_id": owner_id, "created_at": now, "updated_at": now} for blog in blogs]
+    for row in rows:
+        row.update(search_index.bulk_params(row))
+    ids = _insert_returning_ids(
+        db, models.Blog.__table__, rows, search_index.bulk_columns())
+    store_blog_renditions(db, [(blog_id, blog.content) for blog_id, blog in zip(ids, blogs)])
+    _adjust_user_counts(db, owner_id, blogs=len(ids), posted_at=now)
+    _touch_sitemap(db, ids, 1)
+    search_index.index_many(
+        db, [SimpleNamespace(id=blog_id, **blog.dict()) for blog_id, blog in zip(ids, blogs)])
     db.commit()
-    db.refresh(db_blog)
-    return db_blog
+    response_cache.invalidate_blog_lists()
+    return ids
+
+
+def get_blog_owner_id(db: Session, blog_id: int):
+    return db.query(models.Blog.owner_id).filter(models.Blog.id == blog_id).scalar()
+
+
+SEARCH_FIELDS = {"title", "description", "content"}
+
+
+def update_blog(db: Session, blog_id: int, owner_id: int, changes: dict):
+    # Writes only the given columns, in one UPDATE ... WHERE id AND owner_id
+    # RETURNING; None when no such blog belongs to owner_id.
+    extra_columns, params = {}, {}
+    if SEARCH_FIELDS <= changes.keys():
+        extra_columns = search_index.bulk_columns()
+        params = search_index.bulk_params(changes)
+    blogs = models.Blog.__table__
+    statement = update(blogs).where(blogs.c.id == blog_id, blogs.c.owner_id == owner_id).values(
+        **changes, **extra_columns, updated_at=datetime.datetime.now()
+    ).returning(*columns_for(schemas.Blog, models.Blog))
+    blog = db.execute(statement, params).first()
+    if blog is None:
+        db.rollback()
+        return None
+    if SEARCH_FIELDS & changes.keys() and not extra_columns:
+        search_index.reindex(db, blog)
+    if "content" in changes:
+        store_blog_renditions(db, [(blog_id, blog.content)])
+    _touch_sitemap(db, [blog_id])
+    db.commit()
+    response_cache.invalidate_blog(blog_id)
+    response_cache.invalidate_blog_lists()
+    return _with_latest_comments(db, blog)
+
+
+def delete_blog(db: Session, blog_id: int, owner_id: int):
+    # Every statement is limited to a blog owned by owner_id, so nobody
+    # else's blog is touched and no ownership SELECT is needed up front;
+    # None when there is no such blog.
+    blogs = models.Blog.__table__
+    owned = select(blogs.c.id).where(blogs.c.id == blog_id, blogs.c.owner_id == owner_id).scalar_subquery()
+    blog_categories = models.BlogCategory.__table__
+    category_ids = list(db.execute(delete(blog_categories).where(
+        blog_categories.c.blog_id == owned).returning(blog_categories.c.category_id)).scalars())
+    for child in (models.BlogRendition, models.TrendingBlog):
+        db.execute(delete(child.__table__).where(child.__table__.c.blog_id == owned))
+    # Comments outlive their blog, as they did with the ORM delete.
+    db.execute(update(models.Comment.__table__).where(models.Comment.blog_id == owned).values(blog_id=None))
+    blog = db.execute(delete(blogs).where(blogs.c.id == blog_id, blogs.c.owner_id == owner_id).returning(
+        *columns_for(schemas.Blog, models.Blog))).first()
+    if blog is None:
+        db.rollback()
+        return None
+    if category_ids:
+        _adjust_blog_counts(db, category_ids, -1)
+    _adjust_user_counts(db, owner_id, blogs=-1)
+    _touch_sitemap(db, [blog_id], -1)
+    search_index.remove(db, blog_id)
+    db.commit()
+    response_cache.invalidate_blog(blog_id)
+    response_cache.invalidate_blog_categories(blog_id)
+    response_cache.invalidate_blog_lists()
+    return blog
+
+
+def _touch_sitemap(db: Session, blog_ids: list[int], delta: int = 0):
+    # One upsert row per affected shard: adds delta URLs per blog and
+    # moves its lastmod, which is also what versions the feed.
+    now = datetime.datetime.now()
+    shards = Counter(shard_of(blog_id) for blog_id in blog_ids)
+    table = models.SitemapShard.__table__
+    statement = _insert_on_conflict(db, table)
+    db.execute(statement.on_conflict_do_update(index_elements=["shard"], set_={
+        "url_count": table.c.url_count + statement.excluded.url_count,
+        "lastmod": statement.excluded.lastmod,
+    }), [{"shard": shard, "url_count": count * delta, "lastmod": now} for shard, count in shards.items()])
+
+
+def rebuild_sitemap_shards(db: Session) -> int:
+    shard = models.Blog.id // SITEMAP_SHARD_SIZE
+    rows = db.query(shard.label("shard"), func.count().label("url_count"), func.max(models.Blog.updated_at).label("lastmod")).group_by(shard).all()
+    db.query(models.SitemapShard).delete(synchronize_session=False)
+    if rows:
+        db.execute(insert(models.SitemapShard.__table__), [row._asdict() for row in rows])
+    db.commit()
+    return len(rows)
+
+
+def get_feed_version(db: Session):
+    return db.query(func.max(models.SitemapShard.lastmod)).scalar()
+
+
+def get_feed_entries(db: Session, limit: int):
+    # Newest first off ix_blogs_updated_at_id, like GET /blog/.
+    return db.query(
+        models.Blog.id, models.Blog.title, models.Blog.description, models.Blog.created_at,
+        models.Blog.updated_at, models.User.username,
+    ).outerjoin(models.User, models.User.id == models.Blog.owner_id).order_by(
+        models.Blog.updated_at.desc(), models.Blog.id.desc()).limit(limit).all()
+
+
+def get_sitemap_shards(db: Session):
+    return db.query(models.SitemapShard).filter(models.SitemapShard.url_count > 0).order_by(
+        models.SitemapShard.shard).all()
+
+
+def get_sitemap_urls(db: Session, shard: int):
+    return db.query(models.Blog.id, models.Blog.updated_at).filter(
+        models.Blog.id >= shard * SITEMAP_SHARD_SIZE, models.Blog.id < (shard + 1) * SITEMAP_SHARD_SIZE
+    ).order_by(models.Blog.id).all()
+
+
+def flush_activity(db: Session, views: dict[int, int], comments: dict[int, int]):
+    blog_ids = set(views) | set(comments)
+    if not blog_ids:
+        return
+    blogs = models.Blog.__table__
+    # Every touched blog is updated, not only viewed ones: the row locks
+    # serialise concurrent flushes (e.g. from other workers) until commit,
+    # so the scores read below cannot be overwritten by a stale one. Ids
+    # go in ascending order, so concurrent flushes lock in the same order.
+    counts = [(blog_id, views.get(blog_id, 0)) for blog_id in sorted(blog_ids)]
+    if db.get_bind().dialect.name == "postgresql":
+        # One UPDATE ... FROM (VALUES ...): psycopg2 only batches INSERTs,
+        # so an executemany UPDATE would cost a round-trip per blog.
+        counted = values(column("id", Integer), column("views", Integer), name="counted").data(counts)
+        db.execute(update(blogs).where(blogs.c.id == counted.c.id).values(
+            view_count=blogs.c.view_count + counted.c.views))
+    else:
+        # SQLite cannot name a VALUES list's columns; it has no round-trips.
+        db.execute(
+            update(blogs).where(blogs.c.id == bindparam("_id")).values(
+                view_count=blogs.c.view_count + bindparam("_views")),
+            [{"_id": blog_id, "_views": count} for blog_id, count in counts])
+
+    now = datetime.datetime.now()
+    trending = models.TrendingBlog
+    rows = db.query(models.Blog.id, trending.log_score).outerjoin(
+        trending, trending.blog_id == models.Blog.id).filter(models.Blog.id.in_(blog_ids)).all()
+    scores = [
+        {"blog_id": blog_id, "log_score": add_activity(
+            log_score, views.get(blog_id, 0) + comments.get(blog_id, 0) * TRENDING_COMMENT_WEIGHT, now)}
+        for blog_id, log_score in rows]
+    scores = [score for score in scores if score["log_score"] is not None]
+    if scores:
+        statement = _insert_on_conflict(db, trending.__table__)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=["blog_id"], set_={"log_score": statement.excluded.log_score}), scores)
+    db.query(trending).filter(trending.log_score < min_log_score(now)).delete(synchronize_session=False)
+    db.commit()
+    response_cache.invalidate_trending()
 
 
-def delete_blog(db: Session, blog_id: int):
-    db_blog = db.query(models.Blog).filter(models.Blog.id == blog_id).first()
-    db.delete(db_blog)
-    db.commit()
-    return db_blog
+def get_trending_blogs(db: Session, limit: int = 20):
+    now = datetime.datetime.now()
+    rows = db.query(
+        *columns_for(schemas.BlogSummary, models.Blog), models.Blog.view_count, models.Blog.comment_count,
+        models.TrendingBlog.log_score,
+    ).join(models.TrendingBlog, models.TrendingBlog.blog_id == models.Blog.id).order_by(
+        models.TrendingBlog.log_score.desc()).limit(limit).all()
+    return [
+        {**row._asdict(), "score": current_score(row.log_score, now)}
+        for row in rows]
+
 
+def search_blogs(db: Session, q: str, limit: int = 20, after: tuple | None = None):
+    return search_index.search(db, q, limit=limit, after=after)
 
-def get_comments(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Comment).offset(skip).limit(limit).all()
+
+def get_comments(db: Session, skip: int = 0, limit: int = 100, after: tuple | None = None):
+    query = db.query(models.Comment).order_by(models.Comment.id)
+    if after is not None:
+        query = query.filter(models.Comment.id > after[0])
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
 def get_comment_by_id(db: Session, comment_id: int):
     return db.query(models.Comment).filter(models.Comment.id == comment_id).first()
 
 
-def get_comments_by_blog_id(db: Session, blog_id: int):
-    return db.query(models.Comment).filter(models.Comment.blog_id == blog_id).all()
+def get_comments_by_blog_id(db: Session, blog_id: int, limit: int = 100, after: tuple | None = None):
+    # Newest first, seeking on ix_comments_blog_id_created_at_id.
+    query = db.query(models.Comment).filter(models.Comment.blog_id == blog_id).order_by(
+        models.Comment.created_at.desc(), models.Comment.id.desc())
+    if after is not None:
+        query = query.filter(
+            tuple_(models.Comment.created_at, models.Comment.id) < tuple_(*after))
+    return query.limit(limit).all()
+
+
+def _adjust_comment_count(db: Session, blog_id: int, delta: int):
+    db.execute(update(models.Blog).where(models.Blog.id == blog_id).values(
+        comment_count=models.Blog.comment_count + delta))
+
+
+def _publish_comments(type: str, comments):
+    # Deltas for GET /blog/{blog_id}/comment/stream, sent after the commit.
+    for comment in comments:
+        if comment.blog_id is not None:
+            data = serializers.dumps(serializers.trusted(schemas.Comment, comment)).decode()
+            comment_events.publish(comment.blog_id, type, data)
 
 
 def create_comment(db: Session, blog_id: int, user_id: int, comment: schemas.CommentCreate):
@@ -82,31 +509,95 @@ def create_comment(db: Session, blog_id: int, user_id: int, comment: schemas.Com
     db_comment.created_at = datetime.datetime.now()
     db_comment.updated_at = datetime.datetime.now()
     db.add(db_comment)
+    _adjust_comment_count(db, blog_id, 1)
+    _adjust_user_counts(db, user_id, comments=1)
     db.commit()
     db.refresh(db_comment)
+    response_cache.invalidate_blog(blog_id)
+    activity.comment(blog_id)
+    _publish_comments("created", [db_comment])
     return db_comment
 
 
-def update_comment(db: Session, comment_id: int, comment: schemas.CommentCreate):
-    db_comment = db.query(models.Comment).filter(
-        models.Comment.id == comment_id).first()
-    db_comment.content = comment.content
-    db_comment.updated_at = datetime.datetime.now()
+def create_comments_bulk(db: Session, blog_id: int, user_id: int, comments: list[schemas.CommentCreate]) -> list[int]:
+    if not comments:
+        return []
+    now = datetime.datetime.now()
+    rows = [{**comment.dict(), "blog_id": blog_id, "user_id": user_id, "created_at": now, "updated_at": now}
+            for comment in comments]
+    ids = _insert_returning_ids(db, models.Comment.__table__, rows)
+    _adjust_comment_count(db, blog_id, len(ids))
+    _adjust_user_counts(db, user_id, comments=len(ids))
     db.commit()
-    db.refresh(db_comment)
-    return db_comment
-
-
-def delete_comment(db: Session, comment_id: int):
-    db_comment = db.query(models.Comment).filter(
-        models.Comment.id == comment_id).first()
-    db.delete(db_comment)
+    response_cache.invalidate_blog(blog_id)
+    activity.comment(blog_id, len(ids))
+    _publish_comments("created", [SimpleNamespace(**row, id=id) for row, id in zip(rows, ids)])
+    return ids
+
+
+def create_comments_batch(db: Session, comments: list[dict]) -> list[dict]:
+    # Group commit for the comment write buffer: comments for any number of
+    # blogs ({blog_id, user_id, content}) in one INSERT and one commit.
+    if not comments:
+        return []
+    now = datetime.datetime.now()
+    rows = [{**comment, "created_at": now, "updated_at": now} for comment in comments]
+    table = models.Comment.__table__
+    created = [row._asdict() for row in _insert_returning(db, table, rows, *table.c)]
+    counts = Counter(comment["blog_id"] for comment in comments)
+    for blog_id, count in counts.items():
+        _adjust_comment_count(db, blog_id, count)
+    for user_id, count in Counter(comment["user_id"] for comment in comments).items():
+        _adjust_user_counts(db, user_id, comments=count)
     db.commit()
-    return db_comment
+    for blog_id, count in counts.items():
+        response_cache.invalidate_blog(blog_id)
+        activity.comment(blog_id, count)
+    _publish_comments("created", [SimpleNamespace(**comment) for comment in created])
+    return created
+
+
+def get_comment_user_id(db: Session, comment_id: int):
+    return db.query(models.Comment.user_id).filter(models.Comment.id == comment_id).scalar()
+
+
+def update_comment(db: Session, comment_id: int, user_id: int, changes: dict):
+    # One UPDATE ... WHERE id AND user_id RETURNING; None when no such
+    # comment was written by user_id.
+    comments = models.Comment.__table__
+    comment = db.execute(update(comments).where(comments.c.id == comment_id, comments.c.user_id == user_id).values(
+        **changes, updated_at=datetime.datetime.now()).returning(*comments.c)).first()
+    if comment is None:
+        db.rollback()
+        return None
+    db.commit()
+    response_cache.invalidate_blog(comment.blog_id)
+    _publish_comments("updated", [comment])
+    return comment
+
+
+def delete_comment(db: Session, comment_id: int, user_id: int):
+    comments = models.Comment.__table__
+    comment = db.execute(delete(comments).where(comments.c.id == comment_id, comments.c.user_id == user_id).returning(
+        *comments.c)).first()
+    if comment is None:
+        db.rollback()
+        return None
+    _adjust_comment_count(db, comment.blog_id, -1)
+    _adjust_user_counts(db, user_id, comments=-1)
+    db.commit()
+    response_cache.invalidate_blog(comment.blog_id)
+    _publish_comments("deleted", [comment])
+    return comment
 
 
-def get_categories(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Category).offset(skip).limit(limit).all()
+def get_categories(db: Session, skip: int = 0, limit: int = 100, after: tuple | None = None):
+    query = db.query(models.Category).order_by(models.Category.id)
+    if after is not None:
+        query = query.filter(models.Category.id > after[0])
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 
 def get_category_by_id(db: Session, category_id: int):
@@ -118,6 +609,7 @@ def create_category(db: Session, category: schemas.CategoryCreate):
     db.add(db_category)
     db.commit()
     db.refresh(db_category)
+    response_cache.invalidate_category_lists()
     return db_category
 
 
@@ -125,12 +617,75 @@ def get_category_by_name(db: Session, name: str):
     return db.query(models.Category).filter(models.Category.name == name).first()
 
 
+def _insert_on_conflict(db: Session, table):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
+
+def _upsert_categories(db: Session, names: list[str]) -> tuple[list, bool]:
+    # INSERT ... ON CONFLICT (name) DO NOTHING against the unique name, so
+    # concurrent requests can never create the same category twice; then
+    # one SELECT resolves new and existing names alike. The rows are plain
+    # columns rather than ORM objects, so they stay readable after the
+    # caller commits. Also returns whether any category was created, for
+    # the caller to invalidate the category lists once it has committed.
+    if not names:
+        return [], False
+    statement = _insert_on_conflict(db, models.Category.__table__).values(
+        [{"name": name} for name in names]).on_conflict_do_nothing(index_elements=["name"]).returning(
+        models.Category.id)
+    created = db.execute(statement).first() is not None
+    categories = {category.name: category for category in db.query(
+        *columns_for(schemas.Category, models.Category)).filter(models.Category.name.in_(names))}
+    return [categories[name] for name in names], created
+
+
+def get_or_create_category(db: Session, name: str):
+    categories, created = _upsert_categories(db, [name])
+    db.commit()
+    if created:
+        response_cache.invalidate_category_lists()
+    return categories[0]
+
+
+def set_blog_categories(db: Session, blog_id: int, names: list[str]):
+    # Replaces the blog's whole category set in one transaction, touching
+    # only the links that actually change.
+    categories, created = _upsert_categories(db, list(dict.fromkeys(names)))
+    wanted = {category.id for category in categories}
+    table = models.BlogCategory.__table__
+    removed = list(db.execute(delete(table).where(
+        table.c.blog_id == blog_id, table.c.category_id.not_in(wanted)).returning(table.c.category_id)).scalars())
+    added = []
+    if wanted:
+        added = list(db.execute(_insert_on_conflict(db, table).values(
+            [{"blog_id": blog_id, "category_id": category_id} for category_id in wanted]
+        ).on_conflict_do_nothing().returning(table.c.category_id)).scalars())
+    if removed:
+        _adjust_blog_counts(db, removed, -1)
+    if added:
+        _adjust_blog_counts(db, added, 1)
+    db.commit()
+    if created:
+        response_cache.invalidate_category_lists()
+    if removed or added:
+        response_cache.invalidate_blog_categories(blog_id)
+    return categories
+
+
+def _adjust_blog_counts(db: Session, category_ids: list[int], delta: int):
+    db.execute(update(models.Category).where(models.Category.id.in_(category_ids)).values(
+        blog_count=models.Category.blog_count + delta))
+
+
 def add_blog_category(db: Session, blog_id: int, category_id: int):
     db_blog_category = models.BlogCategory(
         blog_id=blog_id, category_id=category_id)
     db.add(db_blog_category)
+    _adjust_blog_counts(db, [category_id], 1)
     db.commit()
     db.refresh(db_blog_category)
+    response_cache.invalidate_blog_categories(blog_id)
     return db_blog_category
 
 
@@ -142,9 +697,46 @@ def delete_blog_category(db: Session, blog_id: int, category_id: int):
     db_blog_category = db.query(models.BlogCategory).filter(models.BlogCategory.blog_id == blog_id).filter(
         models.BlogCategory.category_id == category_id).first()
     db.delete(db_blog_category)
+    _adjust_blog_counts(db, [category_id], -1)
     db.commit()
+    response_cache.invalidate_blog_categories(blog_id)
     return db_blog_category
 
 
 def get_categories_by_blog_id(db: Session, blog_id: int):
     return db.query(models.Category).join(models.BlogCategory, models.Category.id == models.BlogCategory.category_id).filter(models.BlogCategory.blog_id == blog_id).all()
+
+
+def get_blogs_by_category_id(db: Session, category_id: int, limit: int = 100, after: tuple | None = None):
+    # Walks ix_blog_categories_category_id_blog_id, newest blog first.
+    query = db.query(*columns_for(schemas.BlogSummary, models.Blog)).join(models.BlogCategory, models.Blog.id == models.BlogCategory.blog_id).filter(
+        models.BlogCategory.category_id == category_id).order_by(models.BlogCategory.blog_id.desc())
+    if after is not None:
+        query = query.filter(models.BlogCategory.blog_id < after[0])
+    return query.limit(limit).all()
+
+
+def get_category_facets(db: Session, limit: int = 100):
+    return db.query(models.Category).filter(models.Category.blog_count > 0).order_by(
+        models.Category.blog_count.desc(), models.Category.id).limit(limit).all()
+
+
+EXPORT_COLUMNS = {
+    "blogs": ([models.Blog.id, models.Blog.title, models.Blog.description, models.Blog.content,
+               models.Blog.owner_id, models.Blog.created_at, models.Blog.updated_at], models.Blog.updated_at),
+    "comments": ([models.Comment.id, models.Comment.content, models.Comment.blog_id, models.Comment.user_id,
+                  models.Comment.created_at, models.Comment.updated_at], models.Comment.updated_at),
+    "users": ([models.User.id, models.User.username, models.User.joined_at], models.User.joined_at),
+}
+
+
+def stream_export(db: Session, entity: str, updated_since: datetime.datetime | None = None, batch_size: int = 1000):
+    # Plain rows through a server-side cursor (yield_per implies
+    # stream_results), so memory stays flat whatever the table size.
+    columns, since_column = EXPORT_COLUMNS[entity]
+    statement = select(*columns).order_by(columns[0])
+    if updated_since is not None:
+        statement = statement.where(since_column >= updated_since)
+    result = db.execute(statement.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield [row._asdict() for row in partition]
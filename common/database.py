@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
+import itertools
 import os
 from os.path import join, dirname
 from dotenv import load_dotenv
@@ -19,13 +20,112 @@ POSTGRES_DB = os.environ.get("POSTGRES_DB")
 POSTGRES_HOST = os.environ.get("POSTGRES_HOST")
 POSTGRES_PORT = os.environ.get("POSTGRES_PORT")
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# Comma-separated host[:port] list of read replicas sharing the primary's
+# credentials and database name.
+POSTGRES_REPLICA_HOSTS = [
+    host.strip() for host in os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",") if host.strip()]
 
-print(SQLALCHEMY_DATABASE_URL)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={}
-)
+def _database_url(driver: str, host: str, port: str) -> str:
+    return f"{driver}://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{host}:{port}/{POSTGRES_DB}"
+
+
+def _replica_address(replica: str) -> tuple[str, str]:
+    host, _, port = replica.partition(":")
+    return host, port or POSTGRES_PORT
+
+
+# A full SQLAlchemy URL replacing the POSTGRES_* settings, e.g.
+# sqlite:///./blog.db for local runs and tests; no replicas are used then.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+if DATABASE_URL:
+    SQLALCHEMY_DATABASE_URL = DATABASE_URL
+    _url = make_url(DATABASE_URL)
+    SQLALCHEMY_ASYNC_DATABASE_URL = _url.set(drivername=_ASYNC_DRIVERS[_url.get_backend_name()])
+    POSTGRES_REPLICA_HOSTS = []
+else:
+    SQLALCHEMY_DATABASE_URL = _database_url("postgresql", POSTGRES_HOST, POSTGRES_PORT)
+    SQLALCHEMY_ASYNC_DATABASE_URL = _database_url("postgresql+asyncpg", POSTGRES_HOST, POSTGRES_PORT)
+SQLALCHEMY_REPLICA_URLS = [
+    _database_url("postgresql", *_replica_address(replica)) for replica in POSTGRES_REPLICA_HOSTS]
+SQLALCHEMY_ASYNC_REPLICA_URLS = [
+    _database_url("postgresql+asyncpg", *_replica_address(replica)) for replica in POSTGRES_REPLICA_HOSTS]
+
+DATABASE_ASYNC = os.environ.get("DATABASE_ASYNC", "").lower() in ("1", "true", "yes")
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# How long a client's reads stay on the primary after it wrote, so it
+# sees its own changes despite replica lag.
+DB_STICKY_SECONDS = float(os.environ.get("DB_STICKY_SECONDS", 5))
+
+pool_options = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+if DATABASE_URL and _url.get_backend_name() == "sqlite":
+    # SQLite picks its own pool; connections are shared with the threadpool.
+    pool_options = {"connect_args": {"check_same_thread": False}}
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **pool_options)
+replica_engines = [create_engine(url, **pool_options) for url in SQLALCHEMY_REPLICA_URLS]
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Replica sessions are tagged, so responses read through them are not
+# cached while the replica may still be behind (see common.cache).
+ReplicaSessionLocals = [
+    sessionmaker(autocommit=False, autoflush=False, bind=replica, info={"replica": True})
+    for replica in replica_engines
+] or [SessionLocal]
+_replica_sessions = itertools.cycle(ReplicaSessionLocals)
+
+
+def ReadSessionLocal():
+    # Round-robin over the replicas; the primary when there are none.
+    return next(_replica_sessions)()
+
+
+if DATABASE_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, **pool_options)
+    # Objects outlive the commit so handlers can read them without
+    # triggering an implicit (and, on AsyncSession, illegal) reload.
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False)
+    async_replica_engines = [
+        create_async_engine(url, **pool_options) for url in SQLALCHEMY_ASYNC_REPLICA_URLS]
+    AsyncReplicaSessionLocals = [
+        async_sessionmaker(replica, autoflush=False, expire_on_commit=False, info={"replica": True})
+        for replica in async_replica_engines
+    ] or [AsyncSessionLocal]
+    _async_replica_sessions = itertools.cycle(AsyncReplicaSessionLocals)
+
+    def AsyncReadSessionLocal():
+        return next(_async_replica_sessions)()
+
+
+
+def engines() -> list:
+    # Every engine built above, async ones as their sync core (where
+    # events are listened for).
+    built = [engine, *replica_engines]
+    if DATABASE_ASYNC:
+        built += [e.sync_engine for e in (async_engine, *async_replica_engines)]
+    return built
+
+
+def after_fork():
+    # A forked worker must not share pooled connections with its parent.
+    for e in engines():
+        e.dispose(close=False)
+
 
 Base = declarative_base()
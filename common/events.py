@@ -0,0 +1,366 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+
+# Events a subscriber may fall behind by before it is disconnected; it
+# reconnects with Last-Event-ID and catches up from the history.
+COMMENT_STREAM_BUFFER = int(os.environ.get("COMMENT_STREAM_BUFFER", 256))
+# Recent events kept per blog for resuming, and how many blogs keep one.
+COMMENT_STREAM_HISTORY = int(os.environ.get("COMMENT_STREAM_HISTORY", 256))
+COMMENT_STREAM_HISTORY_BLOGS = int(os.environ.get("COMMENT_STREAM_HISTORY_BLOGS", 10000))
+COMMENT_STREAM_KEEPALIVE = float(os.environ.get("COMMENT_STREAM_KEEPALIVE", 15))
+# host:port of the broker (`python -m common.events`) that relays events
+# between workers; unset, each process only sees its own writes.
+COMMENT_STREAM_BROKER = os.environ.get("COMMENT_STREAM_BROKER")
+# Bytes a broker client may have unsent before the broker drops it.
+BROKER_MAX_BACKLOG = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+class Event(NamedTuple):
+    id: int
+    channel: int
+    type: str
+    data: str
+    # Who numbered the event: this process or the broker, per run. Ids
+    # only compare within one origin.
+    origin: str
+
+    @property
+    def event_id(self) -> str:
+        return f"{self.origin}-{self.id}"
+
+
+def parse_event_id(value: str) -> tuple[str, int]:
+    # Inverse of Event.event_id; ValueError when malformed.
+    origin, _, id = value.rpartition("-")
+    if not origin:
+        raise ValueError(value)
+    return origin, int(id)
+
+
+class EventClock:
+    # Ids are microseconds since the epoch, bumped to stay strictly
+    # increasing, so they keep ordering across restarts and a stale
+    # Last-Event-ID can be told apart from one this process has history for.
+
+    def __init__(self):
+        self.last = 0
+
+    def next(self) -> int:
+        self.last = max(self.last + 1, now_id())
+        return self.last
+
+
+def now_id() -> int:
+    return time.time_ns() // 1000
+
+
+class LocalBackend:
+    # Events go straight to this process's hub. publish() may be called
+    # from any thread; ids are assigned on the loop so they arrive in order.
+
+    def __init__(self):
+        self.clock = EventClock()
+        self.origin = ""
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._deliver = None
+
+    async def start(self, deliver, resync):
+        # A new origin per start, so workers forked from one master (or a
+        # restarted one) never accept each other's ids.
+        self._loop, self._deliver = asyncio.get_running_loop(), deliver
+        self.origin = secrets.token_hex(4)
+        resync(self.origin)
+
+    async def stop(self):
+        self._loop = None
+
+    def publish(self, channel: int, type: str, data: str):
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._dispatch, channel, type, data)
+        except RuntimeError:
+            # The loop closed under us; nobody is left to deliver to.
+            pass
+
+    def _dispatch(self, channel: int, type: str, data: str):
+        self._deliver(Event(self.clock.next(), channel, type, data, self.origin))
+
+    def stats(self) -> dict:
+        return {"backend": "local"}
+
+
+class BrokerBackend:
+    # Events are sent to the broker, which numbers them and relays them to
+    # every connected worker, this one included. Events published while
+    # disconnected are dropped, so every (re)connect resyncs the hub:
+    # open streams are closed and resuming across the gap means a reset.
+
+    def __init__(self, address: str):
+        host, _, port = address.rpartition(":")
+        self.host, self.port = host or "127.0.0.1", int(port)
+        self.dropped = 0
+        self.origin = ""
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, deliver, resync):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run(deliver, resync))
+
+    async def stop(self):
+        self._loop = None
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _run(self, deliver, resync):
+        delay = 0.1
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                try:
+                    # The broker greets every connection with its origin.
+                    self.origin = json.loads(await reader.readline())["origin"]
+                except BaseException:
+                    writer.close()
+                    raise
+                self._writer = writer
+                delay = 0.1
+                resync(self.origin)
+                while line := await reader.readline():
+                    message = json.loads(line)
+                    deliver(Event(message["id"], message["channel"], message["type"], message["data"], self.origin))
+            except (OSError, ValueError, KeyError) as exc:
+                logger.warning("Comment stream broker %s:%d: %s", self.host, self.port, exc)
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+    def publish(self, channel: int, type: str, data: str):
+        loop = self._loop
+        if loop is None:
+            return
+        line = json.dumps({"channel": channel, "type": type, "data": data}).encode() + b"\n"
+        try:
+            loop.call_soon_threadsafe(self._send, line)
+        except RuntimeError:
+            pass
+
+    def _send(self, line: bytes):
+        if self._writer is None or self._writer.is_closing():
+            self.dropped += 1
+            return
+        self._writer.write(line)
+
+    def stats(self) -> dict:
+        return {"backend": f"broker {self.host}:{self.port}",
+                "connected": self._writer is not None, "dropped": self.dropped}
+
+
+class Subscription:
+    def __init__(self, channel: int, size: int):
+        self.channel = channel
+        self.size = size
+        # Set when the requested Last-Event-ID cannot be replayed (older
+        # than the history, issued elsewhere, or more than fits): the client
+        # has to reload the list instead of resuming.
+        self.reset = False
+        self.closed = False
+        self._events: deque[Event] = deque()
+        self._ready = asyncio.Event()
+
+    def push(self, event: Event) -> bool:
+        if len(self._events) >= self.size:
+            return False
+        self._events.append(event)
+        self._ready.set()
+        return True
+
+    def clear(self):
+        self._events.clear()
+
+    def close(self):
+        self.closed = True
+        self._events.clear()
+        self._ready.set()
+
+    async def next(self, timeout: float) -> list[Event] | None:
+        # Everything queued so far, [] after `timeout` idle seconds, or
+        # None once the subscription is closed.
+        if not self._events and not self.closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        if self.closed:
+            return None
+        self._ready.clear()
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+
+class EventHub:
+    # In-process fan-out of per-channel (per-blog) events to subscribers.
+    # Everything except publish() runs on the event loop.
+
+    def __init__(self, backend, buffer_size: int, history_size: int, history_channels: int):
+        self.backend = backend
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self.history_channels = history_channels
+        self.delivered = 0
+        self.evicted = 0
+        self.resyncs = 0
+        self.origin: str | None = None
+        self._subscribers: dict[int, set[Subscription]] = {}
+        self._history: OrderedDict[int, deque[Event]] = OrderedDict()
+        # Per channel, the newest id that fell out of its history; anything
+        # before _since (the last resync, or a forgotten channel) may have
+        # been missed.
+        self._floors: dict[int, int] = {}
+        self._since = now_id()
+
+    async def start(self):
+        await self.backend.start(self._deliver, self._resync)
+
+    async def stop(self):
+        await self.backend.stop()
+        self._close_all()
+
+    def _close_all(self):
+        for subscribers in list(self._subscribers.values()):
+            for subscription in list(subscribers):
+                subscription.close()
+        self._subscribers.clear()
+
+    def _resync(self, origin: str):
+        # The backend (re)connected: events may have been lost before this
+        # point. Open streams are closed so their clients reconnect, and
+        # resuming from before now gets a reset; ids of another origin are
+        # never resumable.
+        self.resyncs += 1
+        if origin != self.origin:
+            self._history.clear()
+            self._floors.clear()
+        self.origin = origin
+        self._since = max(self._since, now_id())
+        self._close_all()
+
+    def publish(self, channel: int, type: str, data: str):
+        self.backend.publish(channel, type, data)
+
+    def _deliver(self, event: Event):
+        self.delivered += 1
+        history = self._history.get(event.channel)
+        if history is None:
+            history = self._history[event.channel] = deque(maxlen=self.history_size)
+            while len(self._history) > self.history_channels:
+                channel, forgotten = self._history.popitem(last=False)
+                self._floors.pop(channel, None)
+                self._since = max(self._since, forgotten[-1].id)
+        else:
+            self._history.move_to_end(event.channel)
+        if len(history) == history.maxlen:
+            self._floors[event.channel] = history[0].id
+        history.append(event)
+
+        for subscription in list(self._subscribers.get(event.channel, ())):
+            if not subscription.push(event):
+                # Slow consumer: cut it loose rather than buffer without bound.
+                self.evicted += 1
+                self.unsubscribe(subscription)
+                subscription.close()
+
+    def subscribe(self, channel: int, last_event_id: str | None = None) -> Subscription:
+        # last_event_id is an Event.event_id; ValueError when malformed.
+        subscription = Subscription(channel, self.buffer_size)
+        if last_event_id is not None:
+            origin, last_id = parse_event_id(last_event_id)
+            if origin != self.origin or last_id < max(self._since, self._floors.get(channel, 0)):
+                subscription.reset = True
+            else:
+                for event in self._history.get(channel, ()):
+                    if event.id > last_id and not subscription.push(event):
+                        # More to replay than the buffer holds.
+                        subscription.reset = True
+                        subscription.clear()
+                        break
+        self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.channel)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.channel]
+
+    def stats(self) -> dict:
+        return {
+            **self.backend.stats(),
+            "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+            "channels": len(self._subscribers), "delivered": self.delivered, "evicted": self.evicted,
+            "resyncs": self.resyncs,
+        }
+
+
+comment_events = EventHub(
+    BrokerBackend(COMMENT_STREAM_BROKER) if COMMENT_STREAM_BROKER else LocalBackend(),
+    COMMENT_STREAM_BUFFER, COMMENT_STREAM_HISTORY, COMMENT_STREAM_HISTORY_BLOGS)
+
+
+async def run_broker(host: str, port: int):
+    # Stand-in broker for running several workers on one machine: numbers
+    # every event it receives and relays it to all connected workers.
+    clock = EventClock()
+    origin = secrets.token_hex(4)
+    clients: set[asyncio.StreamWriter] = set()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(json.dumps({"origin": origin}).encode() + b"\n")
+        clients.add(writer)
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                message["id"] = clock.next()
+                out = json.dumps(message).encode() + b"\n"
+                for client in list(clients):
+                    if client.transport.get_write_buffer_size() > BROKER_MAX_BACKLOG:
+                        # A stuck worker reconnects; its streams resume or reset.
+                        clients.discard(client)
+                        client.close()
+                    else:
+                        client.write(out)
+        except (OSError, ValueError):
+            pass
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Comment stream broker listening on %s:%d", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    host, _, port = (COMMENT_STREAM_BROKER or "127.0.0.1:8765").rpartition(":")
+    asyncio.run(run_broker(host or "127.0.0.1", int(port)))
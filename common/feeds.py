@@ -0,0 +1,84 @@
+import os
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+
+FEED_SIZE = int(os.environ.get("FEED_SIZE", 50))
+# The sitemap protocol's limit of URLs per file. Blogs are assigned to a
+# shard by id, so a blog never moves between files.
+SITEMAP_SHARD_SIZE = int(os.environ.get("SITEMAP_SHARD_SIZE", 50000))
+# Public origin used in links, e.g. https://blog.example.com; defaults to
+# the origin the request came in on.
+SITE_URL = os.environ.get("SITE_URL")
+FEED_TITLE = os.environ.get("FEED_TITLE", "Blog")
+
+
+def shard_of(blog_id: int) -> int:
+    return blog_id // SITEMAP_SHARD_SIZE
+
+
+def _timestamp(value: datetime) -> str:
+    # Stored datetimes are naive local time, as everywhere else.
+    return value.astimezone(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+def render_atom(site_url: str, entries: list, updated: datetime | None) -> bytes:
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<feed xmlns="http://www.w3.org/2005/Atom">\n',
+        f"<title>{escape(FEED_TITLE)}</title>\n",
+        f"<id>{escape(site_url)}/</id>\n",
+        f"<link href={quoteattr(site_url + '/')}/>\n",
+        f"<link rel=\"self\" href={quoteattr(site_url + '/feed.atom')}/>\n",
+        f"<updated>{_timestamp(updated or datetime.now())}</updated>\n",
+    ]
+    for entry in entries:
+        url = f"{site_url}/blog/{entry.id}"
+        parts.append(
+            "<entry>"
+            f"<id>{escape(url)}</id>"
+            f"<title>{escape(entry.title or '')}</title>"
+            f"<link href={quoteattr(url + '?format=html')}/>"
+            f"<author><name>{escape(entry.username or '')}</name></author>"
+            f"<published>{_timestamp(entry.created_at)}</published>"
+            f"<updated>{_timestamp(entry.updated_at)}</updated>"
+            f"<summary>{escape(entry.description or '')}</summary>"
+            "</entry>\n")
+    parts.append("</feed>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def render_urlset(site_url: str, urls: list) -> bytes:
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+    ]
+    for url in urls:
+        parts.append(
+            f"<url><loc>{escape(site_url)}/blog/{url.id}</loc>"
+            f"<lastmod>{_timestamp(url.updated_at)}</lastmod></url>\n")
+    parts.append("</urlset>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def render_sitemap_index(site_url: str, shards: list) -> bytes:
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+    ]
+    for shard in shards:
+        parts.append(
+            f"<sitemap><loc>{escape(site_url)}/sitemap-{shard.shard}.xml</loc>"
+            f"<lastmod>{_timestamp(shard.lastmod)}</lastmod></sitemap>\n")
+    parts.append("</sitemapindex>\n")
+    return "".join(parts).encode("utf-8")
+
+
+if __name__ == "__main__":
+    # Rebuilds the sitemap shard table from the blogs, for databases that
+    # predate it.
+    from . import crud
+    from .database import SessionLocal
+
+    with SessionLocal() as db:
+        print(f"rebuilt {crud.rebuild_sitemap_shards(db)} sitemap shards")
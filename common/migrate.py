@@ -0,0 +1,114 @@
+import os
+import sys
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from . import crud, models
+from .database import SessionLocal, engine
+from .search import search_index
+
+
+DATABASE_AUTO_MIGRATE = os.environ.get("DATABASE_AUTO_MIGRATE", "").lower() in ("1", "true", "yes")
+
+
+# Every step is idempotent, so `python -m common.migrate` brings a database
+# created by any earlier version up to date and is safe to re-run.
+
+def _add_missing_columns(conn) -> set[str]:
+    # Columns added to existing tables since they were created; each new
+    # one is either nullable or has a server default.
+    inspector = inspect(conn)
+    added = set()
+    for table in models.Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                spec = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+                added.add(f"{table.name}.{column.name}")
+    return added
+
+
+def _create_missing_indexes(conn):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _unique_category_names(conn):
+    # categories.name used to be a plain index. ON CONFLICT (name) needs a
+    # unique one, so duplicates are merged into the oldest row first.
+    indexes = {index["name"]: index for index in inspect(conn).get_indexes("categories")}
+    if indexes.get("ix_categories_name", {}).get("unique"):
+        return
+    duplicates = "SELECT name, min(id) AS id FROM categories GROUP BY name HAVING count(*) > 1"
+    conn.execute(text(f"""
+        INSERT INTO blog_categories (blog_id, category_id)
+        SELECT bc.blog_id, keep.id FROM blog_categories bc
+        JOIN categories c ON c.id = bc.category_id
+        JOIN ({duplicates}) keep ON keep.name = c.name AND keep.id <> c.id
+        ON CONFLICT DO NOTHING"""))
+    conn.execute(text(f"""
+        DELETE FROM blog_categories bc USING categories c, ({duplicates}) keep
+        WHERE c.id = bc.category_id AND keep.name = c.name AND keep.id <> c.id"""))
+    conn.execute(text(f"""
+        DELETE FROM categories c USING ({duplicates}) keep
+        WHERE keep.name = c.name AND keep.id <> c.id"""))
+    conn.execute(text("DROP INDEX IF EXISTS ix_categories_name"))
+    conn.execute(text("CREATE UNIQUE INDEX ix_categories_name ON categories (name)"))
+
+
+# Denormalised columns, recomputed from the rows they summarise; crud keeps
+# them current from then on.
+COUNTERS = {
+    "categories.blog_count":
+        "UPDATE categories SET blog_count = (SELECT count(*) FROM blog_categories WHERE category_id = categories.id)",
+    "blogs.comment_count":
+        "UPDATE blogs SET comment_count = (SELECT count(*) FROM comments WHERE blog_id = blogs.id)",
+    "users.blog_count":
+        "UPDATE users SET blog_count = (SELECT count(*) FROM blogs WHERE owner_id = users.id)",
+    "users.comment_count":
+        "UPDATE users SET comment_count = (SELECT count(*) FROM comments WHERE user_id = users.id)",
+    "users.last_posted_at":
+        "UPDATE users SET last_posted_at = (SELECT max(created_at) FROM blogs WHERE owner_id = users.id)",
+}
+
+
+def backfill(columns: set[str] | None = None, batch_size: int = 500):
+    # Fills the given newly added columns, or with None recomputes every
+    # derived column; either way the result only depends on the source rows.
+    with SessionLocal() as db:
+        for column, statement in COUNTERS.items():
+            if columns is None or column in columns:
+                db.execute(text(statement))
+        db.commit()
+        if columns is None or "blogs.search_vector" in columns:
+            query = db.query(models.Blog).filter(models.Blog.search_vector.is_(None)).order_by(models.Blog.id)
+            after = 0
+            while batch := query.filter(models.Blog.id > after).limit(batch_size).all():
+                for blog in batch:
+                    search_index.index(db, blog)
+                db.commit()
+                after = batch[-1].id
+        if columns is None or db.query(models.SitemapShard).first() is None:
+            crud.rebuild_sitemap_shards(db)
+
+
+def migrate(backfill_all: bool = False) -> set[str]:
+    # One transaction: a failed step leaves the schema as it was.
+    with engine.begin() as conn:
+        models.Base.metadata.create_all(bind=conn)
+        added = _add_missing_columns(conn)
+        _create_missing_indexes(conn)
+        _unique_category_names(conn)
+    backfill(None if backfill_all else added)
+    return added
+
+
+if __name__ == "__main__":
+    # --backfill recomputes every counter, search vector and the sitemap
+    # shards, not just those of columns added by this run. Blog renditions
+    # are backfilled separately by `python -m common.rendering`.
+    for column in sorted(migrate(backfill_all="--backfill" in sys.argv[1:])):
+        print(f"added {column}")
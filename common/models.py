@@ -1,5 +1,6 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Index, Integer, LargeBinary, String, DateTime, Text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, relationship
 
 from .database import Base
 
@@ -13,10 +14,34 @@ class User(Base):
 
     joined_at = Column(DateTime, nullable=False)
 
+    # Profile stats, maintained by crud whenever the user posts or comments.
+    blog_count = Column(Integer, nullable=False, default=0, server_default="0")
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_posted_at = Column(DateTime)
+
     blogs = relationship("Blog", back_populates="owner")
     comments = relationship("Comment", back_populates="user")
 
 
+class RefreshToken(Base):
+    # Opaque refresh tokens, stored as SHA-256 digests. Each rotation adds
+    # a row to the same family; presenting a used token revokes the family.
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String, nullable=False, unique=True, index=True)
+    family_id = Column(String, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    # When the login behind the family expires; rotation never extends it.
+    # NULL only on rows issued before the column existed.
+    family_expires_at = Column(DateTime, index=True)
+    used_at = Column(DateTime)
+    revoked_at = Column(DateTime)
+
+
 class Blog(Base):
     __tablename__ = "blogs"
 
@@ -30,10 +55,54 @@ class Blog(Base):
     created_at = Column(DateTime, nullable=False)
     updated_at = Column(DateTime, nullable=False)
 
+    # Maintained by crud whenever a comment is added or removed.
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Flushed in batches from common.trending's in-memory counter.
+    view_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    # Maintained by common.search; never needed when loading a blog.
+    search_vector = deferred(Column(TSVECTOR().with_variant(Text(), "sqlite")))
+
     owner = relationship("User", back_populates="blogs")
     comments = relationship("Comment", back_populates="blog")
     blog_categories = relationship("BlogCategory", back_populates="blog")
 
+    __table_args__ = (
+        Index("ix_blogs_updated_at_id", "updated_at", "id"),
+        Index("ix_blogs_owner_id_updated_at_id", "owner_id", "updated_at", "id"),
+        Index("ix_blogs_search_vector", "search_vector", postgresql_using="gin"),
+    )
+
+
+class BlogRendition(Base):
+    # Blog content as served by GET /blog/{id}?format=..., in every
+    # Content-Encoding, produced by common.rendering whenever it is written.
+    __tablename__ = "blog_renditions"
+
+    blog_id = Column(Integer, ForeignKey("blogs.id"), primary_key=True)
+    format = Column(String, primary_key=True)
+    encoding = Column(String, primary_key=True)
+    body = Column(LargeBinary, nullable=False)
+
+
+class TrendingBlog(Base):
+    # The trending ranking, kept up to date by crud.flush_activity; see
+    # common.trending for what log_score means.
+    __tablename__ = "trending_blogs"
+
+    blog_id = Column(Integer, ForeignKey("blogs.id"), primary_key=True)
+    log_score = Column(Float, nullable=False, index=True)
+
+
+class SitemapShard(Base):
+    # Per-shard URL counts and last change times, kept up to date by every
+    # blog write; the feed and sitemap versions are read off this table.
+    __tablename__ = "sitemap_shards"
+
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    url_count = Column(Integer, nullable=False, default=0)
+    lastmod = Column(DateTime, nullable=False)
+
 
 class Comment(Base):
     __tablename__ = "comments"
@@ -50,12 +119,18 @@ class Comment(Base):
     blog = relationship("Blog", back_populates="comments")
     user = relationship("User", back_populates="comments")
 
+    __table_args__ = (
+        Index("ix_comments_blog_id_created_at_id", "blog_id", "created_at", "id"),
+    )
+
 
 class Category(Base):
     __tablename__ = "categories"
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
+    name = Column(String, unique=True, index=True)
+    # Maintained by crud whenever a blog is tagged or untagged.
+    blog_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
 
     blog_categories = relationship("BlogCategory", back_populates="category")
 
@@ -77,3 +152,7 @@ class BlogCategory(Base):
 
     blog = relationship("Blog", back_populates="blog_categories")
     category = relationship("Category", back_populates="blog_categories")
+
+    __table_args__ = (
+        Index("ix_blog_categories_category_id_blog_id", "category_id", "blog_id"),
+    )
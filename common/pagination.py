@@ -0,0 +1,38 @@
+import binascii
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*key) -> str:
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in key]
+    payload = json.dumps(values, separators=(",", ":")).encode()
+    return urlsafe_b64encode(payload).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise InvalidCursor(cursor)
+        return tuple(
+            datetime.fromisoformat(v) if t is datetime else t(v)
+            for t, v in zip(types, values)
+        )
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidCursor(cursor)
+
+
+def next_cursor(rows: list, limit: int, key) -> str | None:
+    # A short page means there is nothing left to seek to.
+    if not rows or len(rows) < limit:
+        return None
+    return encode_cursor(*key(rows[-1]))
@@ -0,0 +1,39 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+SQL_STATEMENT_BUDGET = os.environ.get("SQL_STATEMENT_BUDGET")
+
+_counter: ContextVar[list | None] = ContextVar("sql_statement_counter", default=None)
+
+
+class StatementBudgetExceeded(RuntimeError):
+    pass
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def install(engine):
+    event.listen(engine, "before_cursor_execute", _count_statement)
+
+
+@contextmanager
+def statement_budget(limit: int, label: str = ""):
+    # The counter is a mutable cell so that sync routes running in the
+    # threadpool (with a copied context) still add to the same total.
+    counter = [0]
+    token = _counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _counter.reset(token)
+    if counter[0] > limit:
+        raise StatementBudgetExceeded(
+            f"{label} issued {counter[0]} SQL statements (budget {limit})")
@@ -0,0 +1,127 @@
+import gzip
+import html
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Media types; Response adds the utf-8 charset itself.
+FORMATS = {
+    "markdown": "text/markdown",
+    "html": "text/html",
+}
+# Server preference when a client accepts several.
+ENCODINGS = ("br", "gzip", "identity") if brotli is not None else ("gzip", "identity")
+
+_HEADING = re.compile(r"^(#{1,6})\s*(.*?)\s*#*\s*$")
+_INLINE = re.compile(r"`([^`]+)`|\*\*(.+?)\*\*|\[([^\]]+)\]\((https?://[^\s)]+)\)")
+
+
+def _inline(text: str) -> str:
+    out, pos = [], 0
+    for match in _INLINE.finditer(text):
+        out.append(html.escape(text[pos:match.start()]))
+        code, strong, label, href = match.groups()
+        if code is not None:
+            out.append(f"<code>{html.escape(code)}</code>")
+        elif strong is not None:
+            out.append(f"<strong>{html.escape(strong)}</strong>")
+        else:
+            out.append(f'<a href="{html.escape(href)}">{html.escape(label)}</a>')
+        pos = match.end()
+    out.append(html.escape(text[pos:]))
+    return "".join(out)
+
+
+def render_html(text: str | None) -> str:
+    # The subset of markdown blogs are written in: headings (with or
+    # without the space after the #s), fenced code, paragraphs, inline
+    # code, bold and links. Everything else is escaped, never passed through.
+    blocks, paragraph, code = [], [], None
+
+    def end_paragraph():
+        if paragraph:
+            blocks.append("<p>" + "<br>\n".join(_inline(line) for line in paragraph) + "</p>")
+            paragraph.clear()
+
+    for line in (text or "").splitlines():
+        if code is not None:
+            if line.strip().startswith("```"):
+                blocks.append("<pre><code>" + html.escape("\n".join(code)) + "</code></pre>")
+                code = None
+            else:
+                code.append(line)
+        elif line.strip().startswith("```"):
+            end_paragraph()
+            code = []
+        elif not line.strip():
+            end_paragraph()
+        elif heading := _HEADING.match(line):
+            end_paragraph()
+            level = len(heading.group(1))
+            blocks.append(f"<h{level}>{_inline(heading.group(2))}</h{level}>")
+        else:
+            paragraph.append(line)
+    if code is not None:
+        blocks.append("<pre><code>" + html.escape("\n".join(code)) + "</code></pre>")
+    end_paragraph()
+    return "\n".join(blocks)
+
+
+def compress(body: bytes) -> dict[str, bytes]:
+    # Done once per write, so spend the CPU on the best ratio.
+    bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body, quality=11, mode=brotli.MODE_TEXT)
+    return bodies
+
+
+def render(format: str, content: str | None) -> bytes:
+    return (render_html(content) if format == "html" else content or "").encode("utf-8")
+
+
+def renditions(content: str | None) -> list[dict]:
+    # Rows for models.BlogRendition, minus blog_id.
+    return [
+        {"format": format, "encoding": encoding, "body": body}
+        for format in FORMATS
+        for encoding, body in compress(render(format, content)).items()
+    ]
+
+
+def negotiate(accept_encoding: str | None) -> str:
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    for encoding in ENCODINGS:
+        if encoding == "identity":
+            break
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+if __name__ == "__main__":
+    # Backfill: renders every blog that has no renditions yet, or all of
+    # them with --all (e.g. after changing the renderer).
+    import sys
+
+    from . import crud
+    from .database import SessionLocal
+
+    with SessionLocal() as db:
+        count = crud.backfill_blog_renditions(db, everything="--all" in sys.argv[1:])
+    print(f"rendered {count} blogs")
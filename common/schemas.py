@@ -10,6 +10,10 @@ class CommentCreate(CommentBase):
     content: str = Field(..., example="とても素晴らしいブログでした．面白かったです！！")
 
 
+class CommentUpdate(CommentBase):
+    content: str | None = Field(None, example="とても素晴らしいブログでした．面白かったです！！")
+
+
 class Comment(CommentBase):
     id: int = Field(..., example=1)
     content: str = Field(..., example="とても素晴らしいブログでした．面白かったです！！")
@@ -47,6 +51,10 @@ class Category(CategoryBase):
         orm_mode = True
 
 
+class CategoryFacet(Category):
+    blog_count: int = Field(..., example=12)
+
+
 class BlogCategoryBase(BaseModel):
     pass
 
@@ -70,6 +78,13 @@ class BlogCreate(BlogBase):
     pass
 
 
+class BlogUpdate(BaseModel):
+    # Only the fields sent are written.
+    title: str | None = Field(None, example="Pythonの基礎")
+    description: str | None = Field(None, example="Pythonの基礎を説明しています！")
+    content: str | None = Field(None, example="#Pythonってなに？")
+
+
 class Blog(BlogBase):
     id: int = Field(..., example=1)
     owner_id: int = Field(..., example=1)
@@ -77,7 +92,11 @@ class Blog(BlogBase):
         ..., example="#Pythonってなに？  Pythonとは，テレビ番組の「モンティ・パイソン」に由来するプログラミング言語です．開発者は，Guido van Rossum氏です．")
     created_at: datetime = Field(..., example="2021-01-01T00:00:00.000000")
     updated_at: datetime = Field(..., example="2021-01-01T00:00:00.000000")
+    # The latest comments only; page through the rest with comments_cursor
+    # on /blog/{blog_id}/comment/.
     comments: list[CommentSummary] = []
+    comment_count: int = Field(0, example=42)
+    comments_cursor: str | None = None
 
     class Config:
         orm_mode = True
@@ -91,6 +110,16 @@ class BlogSummary(BlogBase):
         orm_mode = True
 
 
+class TrendingBlogSummary(BlogSummary):
+    view_count: int = Field(..., example=1200)
+    comment_count: int = Field(..., example=34)
+    score: float = Field(..., example=310.5)
+
+
+class BlogSearchResult(BlogSummary):
+    rank: float = Field(..., example=0.6)
+
+
 class UserBase(BaseModel):
     username: str
 
@@ -103,15 +132,38 @@ class User(UserBase):
     id: int
     username: str
     joined_at: datetime | None = None
-    blogs: list[BlogSummary] = []
+    # A user's blogs are paged through GET /user/{username}/blog/.
+    blog_count: int = Field(0, example=12)
+    comment_count: int = Field(0, example=40)
+    last_posted_at: datetime | None = None
 
     class Config:
         orm_mode = True
 
 
+class BulkItemError(BaseModel):
+    index: int = Field(..., example=3)
+    errors: list[dict]
+
+
+class BulkCreated(BaseModel):
+    index: int = Field(..., example=0)
+    id: int = Field(..., example=101)
+
+
+class BulkResult(BaseModel):
+    created: list[BulkCreated] = []
+    errors: list[BulkItemError] = []
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+
+
+class TokenRefresh(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
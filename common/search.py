@@ -0,0 +1,241 @@
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from sqlalchemy import REAL, bindparam, cast, event, func, literal, literal_column, tuple_, update
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import engine
+
+
+# Hiragana, katakana, CJK ideographs and half-width katakana. Postgres has
+# no Japanese parser, so runs of these are indexed as overlapping bigrams
+# plus each single character, and every other word as-is. Queries use the
+# bigrams of longer runs and single characters as they are, so a one-kanji
+# search like 猫 matches wherever that character appears.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f"
+_TOKEN = re.compile(f"([{_CJK}]+)|([^\\W{_CJK}]+)")
+
+# Same relative weights as ts_rank's defaults for A, B and C.
+FIELD_WEIGHTS = {"title": 1.0, "description": 0.4, "content": 0.2}
+
+
+def tokenize(text: str | None, query: bool = False) -> list[str]:
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for cjk, word in _TOKEN.findall(text):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            if not query:
+                tokens.extend(cjk)
+    return tokens
+
+
+class SearchIndex:
+    # Every hook is called inside the transaction that writes the blog.
+
+    def index(self, db: Session, blog: models.Blog):
+        raise NotImplementedError
+
+    def remove(self, db: Session, blog_id: int):
+        raise NotImplementedError
+
+    def search(self, db: Session, q: str, limit: int, after: tuple | None = None) -> list:
+        raise NotImplementedError
+
+    def rebuild(self, db: Session):
+        raise NotImplementedError
+
+    # Bulk inserts: extra INSERT columns written as expressions of bind
+    # parameters, the per-row values for those parameters, and a hook run
+    # once the rows exist.
+    def bulk_columns(self) -> dict:
+        return {}
+
+    def bulk_params(self, values: dict) -> dict:
+        return {}
+
+    def index_many(self, db: Session, blogs: list):
+        pass
+
+    # Re-indexes a blog that was updated with a Core statement (a row or
+    # any object with id, title, description and content).
+    def reindex(self, db: Session, blog):
+        raise NotImplementedError
+
+
+class PostgresSearchIndex(SearchIndex):
+    def _weighted(self, title, description, content):
+        weighted = [
+            func.setweight(func.to_tsvector("simple", text), literal_column(f"'{weight}'"))
+            for text, weight in ((title, "A"), (description, "B"), (content, "C"))
+        ]
+        return weighted[0].op("||")(weighted[1]).op("||")(weighted[2])
+
+    def _vector(self, blog: models.Blog):
+        return self._weighted(*(" ".join(tokenize(getattr(blog, name))) for name in FIELD_WEIGHTS))
+
+    def bulk_columns(self) -> dict:
+        return {"search_vector": self._weighted(*(bindparam(f"{name}_tokens") for name in FIELD_WEIGHTS))}
+
+    def bulk_params(self, values: dict) -> dict:
+        return {f"{name}_tokens": " ".join(tokenize(values[name])) for name in FIELD_WEIGHTS}
+
+    def index(self, db: Session, blog: models.Blog):
+        # Assigned as a SQL expression, so it is written by the same
+        # INSERT/UPDATE that saves the blog.
+        blog.search_vector = self._vector(blog)
+
+    def remove(self, db: Session, blog_id: int):
+        pass
+
+    def reindex(self, db: Session, blog):
+        db.execute(update(models.Blog).where(models.Blog.id == blog.id).values(search_vector=self._vector(blog)))
+
+    def search(self, db: Session, q: str, limit: int, after: tuple | None = None) -> list:
+        tokens = tokenize(q, query=True)
+        if not tokens:
+            return []
+        query = func.plainto_tsquery("simple", " ".join(tokens))
+        rank = func.ts_rank(models.Blog.search_vector, query)
+        rows = db.query(
+            models.Blog.id, models.Blog.title, models.Blog.description,
+            models.Blog.updated_at, rank.label("rank"),
+        ).filter(models.Blog.search_vector.op("@@")(query))
+        if after is not None:
+            # ts_rank is a float4; compare in that precision or the row the
+            # cursor came from would sort before its own cursor again.
+            rows = rows.filter(tuple_(rank, models.Blog.id) < tuple_(cast(literal(after[0]), REAL), literal(after[1])))
+        return rows.order_by(rank.desc(), models.Blog.id.desc()).limit(limit).all()
+
+    def rebuild(self, db: Session):
+        for i, blog in enumerate(db.query(models.Blog).yield_per(500), 1):
+            self.index(db, blog)
+            if i % 500 == 0:
+                db.flush()
+        db.commit()
+
+
+class MemorySearchIndex(SearchIndex):
+    # In-process inverted index with the same interface, for SQLite-backed
+    # runs. It is filled from the database on first use; changes are held
+    # on the session and applied once it commits, or dropped on rollback.
+
+    def __init__(self):
+        self._postings: dict[str, dict[int, float]] = defaultdict(dict)
+        self._documents: dict[int, set[str]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        event.listen(Session, "after_commit", self._apply)
+        event.listen(Session, "after_rollback", self._forget)
+
+    def _add(self, blog_id: int, fields: dict):
+        self._discard(blog_id)
+        scores: dict[str, float] = defaultdict(float)
+        for name, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(fields[name]):
+                scores[token] += weight
+        for token, score in scores.items():
+            self._postings[token][blog_id] = score
+        self._documents[blog_id] = set(scores)
+
+    def _discard(self, blog_id: int):
+        for token in self._documents.pop(blog_id, ()):
+            self._postings[token].pop(blog_id, None)
+
+    def _ensure_loaded(self, db: Session):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                for blog in db.query(models.Blog.id, *(getattr(models.Blog, name) for name in FIELD_WEIGHTS)):
+                    self._add(blog.id, blog._asdict())
+                self._loaded = True
+
+    def _pending(self, db: Session) -> dict:
+        # blog id -> indexed fields, or None to remove it.
+        return db.info.setdefault(self, {})
+
+    def _apply(self, session: Session):
+        pending = session.info.pop(self, None)
+        with self._lock:
+            # Until the first load, the database is the index.
+            if not pending or not self._loaded:
+                return
+            for blog_id, fields in pending.items():
+                if fields is None:
+                    self._discard(blog_id)
+                else:
+                    self._add(blog_id, fields)
+
+    def _forget(self, session: Session):
+        session.info.pop(self, None)
+
+    def index(self, db: Session, blog: models.Blog):
+        if blog.id is None:
+            db.add(blog)
+            db.flush()
+        self.index_many(db, [blog])
+
+    def remove(self, db: Session, blog_id: int):
+        self._pending(db)[blog_id] = None
+
+    def index_many(self, db: Session, blogs: list):
+        pending = self._pending(db)
+        for blog in blogs:
+            pending[blog.id] = {name: getattr(blog, name) for name in FIELD_WEIGHTS}
+
+    def reindex(self, db: Session, blog):
+        self.index_many(db, [blog])
+
+    def search(self, db: Session, q: str, limit: int, after: tuple | None = None) -> list:
+        tokens = set(tokenize(q, query=True))
+        if not tokens:
+            return []
+        self._ensure_loaded(db)
+        with self._lock:
+            postings = [self._postings.get(token, {}) for token in tokens]
+            matches = set.intersection(*(set(p) for p in postings))
+            ranked = sorted(
+                ((sum(p[blog_id] for p in postings), blog_id) for blog_id in matches),
+                reverse=True)
+        if after is not None:
+            ranked = [hit for hit in ranked if hit < tuple(after)]
+        ranked = ranked[:limit]
+        if not ranked:
+            return []
+        summaries = {
+            row.id: row for row in db.query(
+                models.Blog.id, models.Blog.title, models.Blog.description, models.Blog.updated_at,
+            ).filter(models.Blog.id.in_([blog_id for _, blog_id in ranked]))
+        }
+        return [
+            {**summaries[blog_id]._asdict(), "rank": rank}
+            for rank, blog_id in ranked if blog_id in summaries
+        ]
+
+    def rebuild(self, db: Session):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._loaded = False
+        self._ensure_loaded(db)
+
+
+search_index: SearchIndex = (
+    PostgresSearchIndex() if engine.dialect.name == "postgresql" else MemorySearchIndex())
+
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+
+    with SessionLocal() as db:
+        search_index.rebuild(db)
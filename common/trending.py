@@ -0,0 +1,79 @@
+import math
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+
+
+# Seconds between flushes of the in-memory view and comment counts.
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5))
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+# How many views one comment is worth.
+TRENDING_COMMENT_WEIGHT = float(os.environ.get("TRENDING_COMMENT_WEIGHT", 5))
+# Blogs whose decayed score drops below this leave the ranking.
+TRENDING_MIN_SCORE = float(os.environ.get("TRENDING_MIN_SCORE", 0.05))
+TRENDING_MAX_LIMIT = 100
+
+# Scores are stored as log(sum of weight * 2 ** (age of event / half-life))
+# measured from a fixed epoch. Every blog decays at the same rate, so this
+# orders blogs exactly like their decayed scores without ever rewriting
+# rows that saw no new activity; logs keep it from overflowing.
+_EPOCH = datetime(2024, 1, 1)
+
+
+def log_growth(now: datetime) -> float:
+    return (now - _EPOCH).total_seconds() / (TRENDING_HALF_LIFE_HOURS * 3600) * math.log(2)
+
+
+def add_activity(log_score: float | None, weight: float, now: datetime) -> float | None:
+    if weight <= 0:
+        return log_score
+    added = math.log(weight) + log_growth(now)
+    if log_score is None:
+        return added
+    high, low = max(log_score, added), min(log_score, added)
+    return high + math.log1p(math.exp(low - high))
+
+
+def current_score(log_score: float, now: datetime) -> float:
+    return math.exp(log_score - log_growth(now))
+
+
+def min_log_score(now: datetime) -> float:
+    return math.log(TRENDING_MIN_SCORE) + log_growth(now)
+
+
+class ActivityCounter:
+    # Views and new comments per blog, added up in memory and handed to
+    # crud.flush_activity in one batch every ACTIVITY_FLUSH_INTERVAL.
+
+    def __init__(self):
+        self._views: Counter = Counter()
+        self._comments: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def view(self, blog_id: int):
+        with self._lock:
+            self._views[blog_id] += 1
+
+    def comment(self, blog_id: int, count: int = 1):
+        with self._lock:
+            self._comments[blog_id] += count
+
+    def drain(self) -> tuple[Counter, Counter]:
+        with self._lock:
+            views, comments = self._views, self._comments
+            self._views, self._comments = Counter(), Counter()
+        return views, comments
+
+    def restore(self, views: Counter, comments: Counter):
+        # A failed flush puts its counts back for the next attempt.
+        with self._lock:
+            self._views.update(views)
+            self._comments.update(comments)
+
+    def stats(self) -> dict:
+        return {"pending_views": sum(self._views.values()), "pending_comments": sum(self._comments.values())}
+
+
+activity = ActivityCounter()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+
+COMMENT_WRITE_BUFFER = os.environ.get("COMMENT_WRITE_BUFFER", "").lower() in ("1", "true", "yes")
+COMMENT_WRITE_BUFFER_WINDOW_MS = float(os.environ.get("COMMENT_WRITE_BUFFER_WINDOW_MS", 5))
+COMMENT_WRITE_BUFFER_MAX_ITEMS = int(os.environ.get("COMMENT_WRITE_BUFFER_MAX_ITEMS", 100))
+
+
+class WriteBuffer:
+    # Group commit: items submitted within `window` seconds of each other
+    # (or until `max_items` are waiting) are handed to `flush` as one list,
+    # and each submitter gets back the result at its own position.
+    # `flush` is an async callable returning one result per item, in order.
+
+    def __init__(self, flush, window: float, max_items: int):
+        self._flush = flush
+        self.window = window
+        self.max_items = max_items
+        self.batches = 0
+        self.items = 0
+        self._pending: list[tuple[object, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Whatever was queued on a previous (now stopped) loop is gone.
+            self._loop, self._pending, self._timer = loop, [], None
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_items:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        items = [item for item, _ in batch]
+        try:
+            results = await self._flush(items)
+        except Exception:
+            # One bad item (e.g. its blog was deleted meanwhile) must not
+            # fail its neighbours: write them one at a time instead.
+            results = []
+            for item in items:
+                try:
+                    results.extend(await self._flush([item]))
+                except Exception as e:
+                    results.append(e)
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items, "pending": len(self._pending)}
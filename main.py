@@ -1,17 +1,89 @@
-from fastapi import Depends, FastAPI
+import asyncio
+
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.security import OAuth2PasswordBearer
 
-from api import auth, user, blog, comment, category
+from api import auth, user, blog, comment, category, export, feed, metrics
 
-from common.database import engine
-from common import models
+from common.database import engines
+from common import admission, migrate, querycount, serializers
+from common.events import comment_events
 
-app = FastAPI()
+app = FastAPI(
+    default_response_class=ORJSONResponse
+    if serializers.FAST_SERIALIZATION and serializers.orjson else JSONResponse
+)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-models.Base.metadata.create_all(bind=engine)
+# Development convenience only; deployments run `python -m common.migrate`.
+if migrate.DATABASE_AUTO_MIGRATE:
+    migrate.migrate()
+
+
+# Test mode: fail any request that issues more SQL than the budget allows.
+if querycount.SQL_STATEMENT_BUDGET:
+    for engine in engines():
+        querycount.install(engine)
+
+    @app.middleware("http")
+    async def enforce_statement_budget(request: Request, call_next):
+        label = f"{request.method} {request.url.path}"
+        with querycount.statement_budget(int(querycount.SQL_STATEMENT_BUDGET), label):
+            return await call_next(request)
+
+
+# Registered last, so it runs first: shed load before any other work.
+if admission.ADMISSION_CONTROL:
+    def _rejected(status_code: int, detail: str, retry_after: int):
+        return JSONResponse(
+            {"detail": detail}, status_code=status_code, headers={"Retry-After": str(retry_after)})
+
+    @app.middleware("http")
+    async def admission_control(request: Request, call_next):
+        group = admission.route_group(request.method, request.url.path)
+        bulkhead = admission.admission.bulkheads.get(group)
+        if bulkhead is None:
+            return await call_next(request)
+        retry_after = admission.admission.rate_limiter.take(auth.rate_limit_key(request))
+        if retry_after:
+            return _rejected(429, "Too many requests", retry_after)
+        if not await bulkhead.acquire():
+            return _rejected(503, "Server busy, please retry", 1)
+        try:
+            response: Response = await call_next(request)
+        except BaseException:
+            bulkhead.release()
+            raise
+
+        # Hold the slot until the body is sent, which for streamed exports
+        # is long after call_next returns.
+        async def body(chunks):
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                bulkhead.release()
+
+        response.body_iterator = body(response.body_iterator)
+        return response
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.activity_flusher = asyncio.create_task(blog.flush_activity_periodically())
+    app.state.refresh_token_purger = asyncio.create_task(auth.purge_refresh_tokens_periodically())
+    await comment_events.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.activity_flusher.cancel()
+    app.state.refresh_token_purger.cancel()
+    await comment_events.stop()
+    await blog.flush_activity()
 
 
 @app.get("/")
@@ -24,3 +96,6 @@ app.include_router(user.router)
 app.include_router(blog.router)
 app.include_router(comment.router)
 app.include_router(category.router)
+app.include_router(export.router)
+app.include_router(feed.router)
+app.include_router(metrics.router)
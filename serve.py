@@ -0,0 +1,166 @@
+import logging
+import logging.config
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+from uvicorn.config import LOGGING_CONFIG
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8000))
+# Response caches and comment streams are per process unless
+# RESPONSE_CACHE_URL and COMMENT_STREAM_BROKER point at shared ones, and a
+# write on one worker would not reach the others: more than one worker
+# needs both.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+SHARED_STATE = {name: os.environ.get(name) for name in ("RESPONSE_CACHE_URL", "COMMENT_STREAM_BROKER")}
+# Connections all workers together may hold to each database server;
+# split evenly into the workers' pools. Unset keeps DB_POOL_SIZE as is.
+DB_CONNECTION_BUDGET = os.environ.get("DB_CONNECTION_BUDGET")
+# With DATABASE_ASYNC each worker has a sync and an async engine per
+# server (exports and maintenance still go through the sync one), and
+# both pools are sized from DB_POOL_SIZE.
+ENGINES_PER_SERVER = 2 if os.environ.get("DATABASE_ASYNC", "").lower() in ("1", "true", "yes") else 1
+# Seconds a worker gets to finish in-flight requests after SIGTERM.
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info")
+# A worker that dies within this many seconds of starting is restarted
+# after an exponentially growing delay, up to RESPAWN_MAX_DELAY.
+RESPAWN_MIN_UPTIME = 10
+RESPAWN_MAX_DELAY = 30
+
+logging.config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger("uvicorn.error")
+
+
+def _rss_mb() -> float:
+    # Peak resident set; pages shared with the master after fork count
+    # towards every worker.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _size_pools():
+    if not DB_CONNECTION_BUDGET:
+        return
+    per_pool = max(1, int(DB_CONNECTION_BUDGET) // (WEB_CONCURRENCY * ENGINES_PER_SERVER))
+    os.environ["DB_POOL_SIZE"] = str(per_pool)
+    os.environ["DB_MAX_OVERFLOW"] = "0"
+    logger.info("DB pool: %d connections per pool, %d pool(s) per worker (budget %s over %d workers)",
+                per_pool, ENGINES_PER_SERVER, DB_CONNECTION_BUDGET, WEB_CONCURRENCY)
+
+
+def _bind() -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket):
+    forked_at = time.perf_counter()
+
+    from common import database
+    database.after_fork()
+
+    async def report_ready():
+        logger.info("Worker %d ready in %.0f ms, max RSS %.1f MB",
+                    os.getpid(), (time.perf_counter() - forked_at) * 1000, _rss_mb())
+
+    app.router.on_startup.append(report_ready)
+    config = uvicorn.Config(
+        app, lifespan="on", log_level=LOG_LEVEL, timeout_graceful_shutdown=GRACEFUL_TIMEOUT)
+    # uvicorn's own SIGTERM handling stops accepting, then drains.
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _spawn(app, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(app, sock)
+        except BaseException:
+            logger.exception("Worker %d crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    started_at = time.perf_counter()
+    missing = [name for name, value in SHARED_STATE.items() if not value]
+    if WEB_CONCURRENCY > 1 and missing:
+        logger.error("WEB_CONCURRENCY=%d needs %s; refusing to serve stale data from per-worker state",
+                     WEB_CONCURRENCY, " and ".join(missing))
+        return 1
+    _size_pools()
+    # Preloaded once in the master; workers share its pages copy-on-write.
+    # The schema is not touched here: run `python -m common.migrate` first.
+    from main import app
+    logger.info("App loaded in %.0f ms, max RSS %.1f MB",
+                (time.perf_counter() - started_at) * 1000, _rss_mb())
+
+    sock = _bind()
+    now = time.monotonic()
+    # pid -> start time, and restart times of workers that died.
+    workers = {_spawn(app, sock): now for _ in range(WEB_CONCURRENCY)}
+    respawns: list[float] = []
+    crashes = 0
+    logger.info("Serving on %s:%d with %d workers", HOST, PORT, len(workers))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info("Draining %d workers", len(workers))
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    deadline = None
+    while workers or (respawns and not stopping):
+        pid = 0
+        if workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        if not stopping:
+            for due in [due for due in respawns if due <= time.monotonic()]:
+                respawns.remove(due)
+                workers[_spawn(app, sock)] = time.monotonic()
+        if pid == 0:
+            if stopping:
+                deadline = deadline or time.monotonic() + GRACEFUL_TIMEOUT + 5
+                if time.monotonic() > deadline:
+                    for pid in workers:
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+            time.sleep(0.2)
+            continue
+        uptime = time.monotonic() - workers.pop(pid)
+        if not stopping:
+            crashes = crashes + 1 if uptime < RESPAWN_MIN_UPTIME else 0
+            delay = min(RESPAWN_MAX_DELAY, 0.5 * 2 ** crashes) if crashes else 0
+            logger.warning("Worker %d exited with status %d after %.0f s, restarting in %.1f s",
+                           pid, os.waitstatus_to_exitcode(status), uptime, delay)
+            respawns.append(time.monotonic() + delay)
+    sock.close()
+    logger.info("Stopped")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
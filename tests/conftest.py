@@ -0,0 +1,4 @@
+import os
+
+# Tests run against in-memory SQLite unless pointed at another database.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
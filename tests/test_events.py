@@ -0,0 +1,127 @@
+import asyncio
+import socket
+
+from common.events import BrokerBackend, EventHub, LocalBackend, run_broker
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def started_hub(buffer_size=4, history_size=8, history_channels=4):
+    hub = EventHub(LocalBackend(), buffer_size, history_size, history_channels)
+    await hub.start()
+    return hub
+
+
+async def publish(hub, channel, *types):
+    for type in types:
+        hub.publish(channel, type, "{}")
+    # LocalBackend delivers on the next loop iteration.
+    await asyncio.sleep(0)
+
+
+async def received(subscription):
+    return [event.type for event in await subscription.next(timeout=0.1) or ()]
+
+
+def test_slow_subscriber_is_evicted():
+    async def main():
+        hub = await started_hub(buffer_size=2)
+        slow, other = hub.subscribe(1), hub.subscribe(2)
+        await publish(hub, 1, "a", "b", "c")
+        return hub, slow, other
+
+    hub, slow, other = run(main())
+    assert slow.closed and not other.closed
+    assert hub.evicted == 1
+    assert hub.stats()["subscribers"] == 1
+
+
+def test_resume_replays_events_after_last_event_id():
+    async def main():
+        hub = await started_hub()
+        first = hub.subscribe(1)
+        await publish(hub, 1, "a", "b", "c")
+        events = await first.next(timeout=0.1)
+        resumed = hub.subscribe(1, events[0].event_id)
+        return resumed.reset, await received(resumed)
+
+    assert run(main()) == (False, ["b", "c"])
+
+
+def test_resume_from_forgotten_history_resets():
+    async def main():
+        hub = await started_hub(history_size=2)
+        first = hub.subscribe(1)
+        await publish(hub, 1, "a", "b", "c", "d")
+        oldest = (await first.next(timeout=0.1))[0]
+        resumed = hub.subscribe(1, oldest.event_id)
+        return resumed.reset, await received(resumed)
+
+    assert run(main()) == (True, [])
+
+
+def test_resume_from_another_origin_resets():
+    async def main():
+        other = await started_hub()
+        subscription = other.subscribe(1)
+        await publish(other, 1, "a")
+        foreign = (await subscription.next(timeout=0.1))[0]
+        hub = await started_hub()
+        await publish(hub, 1, "b")
+        resumed = hub.subscribe(1, foreign.event_id)
+        return resumed.reset, await received(resumed)
+
+    assert run(main()) == (True, [])
+
+
+def test_resume_past_the_buffer_resets():
+    async def main():
+        hub = await started_hub(buffer_size=2, history_size=8)
+        first = hub.subscribe(1)
+        await publish(hub, 1, "a")
+        last = (await first.next(timeout=0.1))[0]
+        await publish(hub, 1, "b", "c", "d")
+        resumed = hub.subscribe(1, last.event_id)
+        return resumed.reset, await received(resumed)
+
+    assert run(main()) == (True, [])
+
+
+def test_resync_closes_streams_and_resets_resumes():
+    async def main():
+        hub = await started_hub()
+        subscription = hub.subscribe(1)
+        await publish(hub, 1, "a")
+        last = (await subscription.next(timeout=0.1))[0]
+        hub._resync(hub.origin)
+        await publish(hub, 1, "b")
+        return subscription.closed, hub.subscribe(1, last.event_id).reset
+
+    assert run(main()) == (True, True)
+
+
+def test_broker_connect_resyncs_subscribers():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    async def main():
+        backend = BrokerBackend(f"127.0.0.1:{port}")
+        hub = EventHub(backend, 4, 8, 4)
+        await hub.start()
+        early = hub.subscribe(1)
+        hub.publish(1, "lost", "{}")
+        await asyncio.sleep(0)
+        broker = asyncio.create_task(run_broker("127.0.0.1", port))
+        while not hub.resyncs:
+            await asyncio.sleep(0.05)
+        subscription = hub.subscribe(1)
+        hub.publish(1, "a", "{}")
+        events = await subscription.next(timeout=1)
+        await hub.stop()
+        broker.cancel()
+        return backend.dropped, early.closed, [event.type for event in events], events[0].origin == backend.origin
+
+    assert run(main()) == (1, True, ["a"], True)
@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+
+from common import models
+from common.database import SessionLocal, engine
+from common.search import MemorySearchIndex, tokenize
+
+
+@pytest.fixture
+def db():
+    models.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as session:
+        yield session
+    models.Base.metadata.drop_all(bind=engine)
+
+
+def test_tokenize_keeps_words_and_normalises_width_and_case():
+    assert tokenize("Hello, ＷＯＲＬＤ 2024!") == ["hello", "world", "2024"]
+    assert tokenize(None) == [] and tokenize("") == []
+
+
+def test_tokenize_indexes_cjk_bigrams_and_characters():
+    assert tokenize("猫が好きです") == [
+        "猫が", "が好", "好き", "きで", "です", "猫", "が", "好", "き", "で", "す"]
+
+
+def test_tokenize_queries_use_bigrams_or_single_characters():
+    assert tokenize("猫が好き", query=True) == ["猫が", "が好", "好き"]
+    assert tokenize("猫", query=True) == ["猫"]
+    assert tokenize("ﾈｺ Python", query=True) == ["ネコ", "python"]
+
+
+def test_single_character_query_matches_inside_longer_runs():
+    for text in ("猫が好きです", "黒猫", "三毛猫と犬"):
+        assert set(tokenize("猫", query=True)) <= set(tokenize(text))
+
+
+def add_blog(db, title, content="", description=""):
+    now = datetime.datetime.now()
+    blog = models.Blog(title=title, description=description, content=content, created_at=now, updated_at=now)
+    db.add(blog)
+    db.flush()
+    return blog
+
+
+def ids(results):
+    return [result["id"] for result in results]
+
+
+def test_memory_index_ranks_title_matches_first(db):
+    index = MemorySearchIndex()
+    body = add_blog(db, "cooking", content="python recipes")
+    title = add_blog(db, "python basics")
+    index.index_many(db, [body, title])
+    db.commit()
+    assert ids(index.search(db, "python", limit=10)) == [title.id, body.id]
+
+
+def test_memory_index_applies_changes_only_on_commit(db):
+    index = MemorySearchIndex()
+    kept = add_blog(db, "python basics")
+    db.commit()
+    assert ids(index.search(db, "python", limit=10)) == [kept.id]
+
+    index.index(db, add_blog(db, "python advanced"))
+    index.remove(db, kept.id)
+    db.rollback()
+    assert ids(index.search(db, "python", limit=10)) == [kept.id]
+
+    index.remove(db, kept.id)
+    assert ids(index.search(db, "python", limit=10)) == [kept.id]
+    db.commit()
+    assert index.search(db, "python", limit=10) == []
+
+
+def test_memory_index_finds_single_kanji(db):
+    index = MemorySearchIndex()
+    cat = add_blog(db, "黒猫の本")
+    add_blog(db, "犬")
+    db.commit()
+    assert ids(index.search(db, "猫", limit=10)) == [cat.id]
+    assert ids(index.search(db, "本", limit=10)) == [cat.id]
+
+
+def test_memory_index_pages_by_rank_and_id(db):
+    index = MemorySearchIndex()
+    blogs = [add_blog(db, "python") for _ in range(3)]
+    db.commit()
+    first = index.search(db, "python", limit=2)
+    rest = index.search(db, "python", limit=2, after=(first[-1]["rank"], first[-1]["id"]))
+    assert ids(first) + ids(rest) == sorted((blog.id for blog in blogs), reverse=True)
@@ -0,0 +1,89 @@
+import asyncio
+
+from common.writebuffer import WriteBuffer
+
+
+class Flusher:
+    # Records every batch and echoes items back, failing any item in `bad`.
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        if self.bad.intersection(items):
+            raise ValueError("bad item")
+        return [f"row-{item}" for item in items]
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_results_come_back_in_submission_order():
+    flush = Flusher()
+    buffer = WriteBuffer(flush, window=0.01, max_items=100)
+
+    async def main():
+        return await asyncio.gather(*(buffer.submit(n) for n in range(10)))
+
+    assert run(main()) == [f"row-{n}" for n in range(10)]
+    assert flush.batches == [list(range(10))]
+
+
+def test_failing_item_does_not_fail_its_batch():
+    flush = Flusher(bad={3})
+    buffer = WriteBuffer(flush, window=0.01, max_items=100)
+
+    async def main():
+        return await asyncio.gather(*(buffer.submit(n) for n in range(5)), return_exceptions=True)
+
+    results = run(main())
+    assert [r for n, r in enumerate(results) if n != 3] == ["row-0", "row-1", "row-2", "row-4"]
+    assert isinstance(results[3], ValueError)
+    # The whole batch first, then every item on its own.
+    assert flush.batches == [[0, 1, 2, 3, 4], [0], [1], [2], [3], [4]]
+
+
+def test_flushes_when_max_items_are_waiting():
+    flush = Flusher()
+    # A window far longer than the test: only max_items can trigger it.
+    buffer = WriteBuffer(flush, window=60, max_items=3)
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*(buffer.submit(n) for n in range(3))), 1)
+
+    assert run(main()) == ["row-0", "row-1", "row-2"]
+    assert flush.batches == [[0, 1, 2]]
+
+
+def test_flushes_when_the_window_expires():
+    flush = Flusher()
+    buffer = WriteBuffer(flush, window=0.05, max_items=100)
+
+    async def main():
+        first = asyncio.ensure_future(buffer.submit(1))
+        await asyncio.sleep(0.01)
+        assert not first.done() and flush.batches == []
+        second = asyncio.ensure_future(buffer.submit(2))
+        results = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        # A submission after the flush starts a new window.
+        return results, await buffer.submit(3)
+
+    assert run(main()) == (["row-1", "row-2"], "row-3")
+    assert flush.batches == [[1, 2], [3]]
+    assert buffer.stats() == {"batches": 2, "items": 3, "pending": 0}
+
+
+def test_whole_batch_failure_reaches_every_submitter():
+    async def flush(items):
+        raise RuntimeError("database down")
+
+    buffer = WriteBuffer(flush, window=0.01, max_items=100)
+
+    async def main():
+        return await asyncio.gather(buffer.submit(1), buffer.submit(2), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in run(main()))
+